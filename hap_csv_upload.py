@@ -2,74 +2,43 @@
 
 import sys
 import argparse
-import zmq
-import io
-import json
 import csv
 import datetime
 import struct
 import re
+import os
+import glob
+import time
+import threading
+import functools
+import multiprocessing
 
 import dateutil.tz
 
-def sec_from_period(period):
-    if period == "M1":
-        return 60
-    elif period == "M5":
-        return 60 * 5
-    elif period == "M15":
-        return 60 * 15
-    elif period == "M30":
-        return 60 * 30
-    elif period == "H1":
-        return 60 * 60
-    elif period == "D":
-        return 86400
-
-
-def get_month_code(month):
-    if month < 1 or month > 12:
-        return None
-    codes = ['F', 'G', 'H', 'J', 'K', 'M', 'N', 'Q', 'U', 'V', 'X', 'Z']
-    return codes[month - 1]
+from mdstools import profiling
+from mdstools.bars import BAR_FORMAT, PARSED_BAR_FORMAT, BarSeries
+from mdstools.compression import open_input
+from mdstools.futures import get_month_code
+from mdstools.hap import HapClient
+from mdstools.manifest import Manifest, fingerprint
+from mdstools.timeframes import sec_from_period
+from mdstools.validation import POLICIES, ValidationError, validate_series
 
-def main():
-    parser = argparse.ArgumentParser(description='Finam quote downloader')
-    parser.add_argument('-i', '--input-file', action='store', dest='input_file', help='Input filename', required=True)
-    parser.add_argument('-p', '--timeframe', action='store', dest='timeframe', help='Data timeframe', required=True)
-    parser.add_argument('-o', '--hap', action='store', dest='hap', help='HAP endpoint', required=True)
-    parser.add_argument('-y', '--hap-symbol', action='store', dest='hap_symbol', help='HAP symbol', required=True)
-    parser.add_argument('-d', '--time-delta', action='store', dest='time_delta', help='Time delta (seconds)')
-    parser.add_argument('-f', '--force-from', action='store', dest='force_from', help='Force period start')
-    parser.add_argument('-t', '--force-to', action='store', dest='force_to', help='Force period end')
-    parser.add_argument('-z', '--timezone', action='store', dest='timezone', help='Timestamps timezone')
-
-
-    args = parser.parse_args()
-
-    period = args.timeframe
+# Parsed files in flight per parser process in bulk mode
+UPLOAD_WINDOW = 4
 
+def bars_range(bars):
     utc_tz = dateutil.tz.gettz('UTC')
-    if args.timezone is None:
-        tz = utc_tz
-    else:
-        tz = dateutil.tz.gettz(args.timezone)
-
-    out_symbol = args.hap_symbol
+    if len(bars) == 0:
+        return None, None
+    return datetime.datetime.fromtimestamp(min(bars.timestamps), utc_tz), datetime.datetime.fromtimestamp(max(bars.timestamps), utc_tz)
 
-    ctx = zmq.Context.instance()
-    s = ctx.socket(zmq.REQ)
-    s.connect(args.hap)
-    serialized_bars = io.BytesIO()
-    min_dt = None
-    max_dt = None
-    time_delta = datetime.timedelta(hours=0)
-    if args.time_delta is not None:
-        time_delta = datetime.timedelta(seconds=int(args.time_delta))
-        print('Applying delta:', time_delta)
+def read_bars(filename, tz, time_delta, bar_format=BAR_FORMAT):
+    serialized_bars = bytearray()
+    pack = struct.Struct(bar_format).pack
     line_count = 0
     ticker = None
-    with open(args.input_file, 'r') as f:
+    with open_input(filename) as f, profiling.section('encode'):
         reader = csv.reader(f, delimiter=',')
         next(reader)
         for line in reader:
@@ -77,8 +46,7 @@ def main():
             if ticker is None:
                 ticker = line[0]
             elif ticker != line[0]:
-                print('Different tickers in file, aborting')
-                break
+                raise ValueError('Different tickers in file: {} and {}'.format(ticker, line[0]))
                 
             date = line[2]
             time = line[3]
@@ -97,67 +65,255 @@ def main():
 
             dt = datetime.datetime(year, month, day, hour, minute, second, 0, tzinfo=tz) - time_delta
 
-            dt = dt.astimezone(utc_tz)
-            serialized_bars.write(struct.pack("<qddddQ", int(dt.timestamp()), float(open_), float(high), float(low), float(close), int(volume)))
+            serialized_bars += pack(int(dt.timestamp()), float(open_), float(high), float(low), float(close), int(volume))
 
-            if min_dt is None:
-                min_dt = dt
-            else:
-                if dt < min_dt:
-                    min_dt = dt
+    bars = BarSeries(serialized_bars)
+    min_dt, max_dt = bars_range(bars)
 
-            if max_dt is None:
-                max_dt = dt
-            else:
-                if dt > max_dt:
-                    max_dt = dt
-
-    if args.force_from is not None:
-        min_dt = datetime.datetime.strptime(args.force_from, "%Y%m%d")
-
-    if args.force_to is not None:
-        max_dt = datetime.datetime.strptime(args.force_to, "%Y%m%d")
-
-    out_ticker = out_symbol
+    return ticker, bars, min_dt, max_dt, line_count
 
+def map_ticker(out_symbol, ticker):
     if out_symbol[0] == '@':
         base = out_symbol[1:]
         matches = re.match('^([^-]+)-(\\d+)\\.(\\d+)$', ticker)
         if not matches:
-            print('Invalid ticker id in file')
-            return
+            return None
         year_code = matches.group(3)[-1]
         month_code = get_month_code(int(matches.group(2)))
 
-        out_ticker = base + month_code + year_code
+        return base + month_code + year_code
 
     elif out_symbol[0] == '~':
         base = out_symbol[1:]
         matches = re.match('^([^-]+)-(\\d+)\\.(\\d+)$', ticker)
         if not matches:
-            print('Invalid ticker id in file')
-            return
+            return None
         year_code = matches.group(3)
         month_code = matches.group(2)
 
-        out_ticker = base + "-" + month_code + '.' + year_code
+        return base + "-" + month_code + '.' + year_code
 
-        print("Resulting ticker: {}".format(out_ticker))
+    return out_symbol
+
+def get_timezone(name):
+    if name is None:
+        return dateutil.tz.gettz('UTC')
+    return dateutil.tz.gettz(name)
+
+def parse_date(x):
+    if x is None:
+        return None
+    return datetime.datetime.strptime(x, "%Y%m%d")
+
+def prepare_file(filename, timezone, time_delta, out_symbol, force_from, force_to, timeframe_sec=None, validation=None):
+    result = { 'file' : filename, 'bars' : 0 }
+    try:
+        bar_format = BAR_FORMAT if validation is None else PARSED_BAR_FORMAT
+        ticker, bars, min_dt, max_dt, line_count = read_bars(filename, get_timezone(timezone), time_delta, bar_format)
+        if line_count == 0:
+            result['error'] = 'Empty file'
+            return result
+
+        if validation is not None:
+            bars = validate_series(bars, timeframe_sec, validation, ticker)
+            min_dt, max_dt = bars_range(bars)
+            if len(bars) == 0:
+                result['error'] = 'No valid bars'
+                return result
+
+        out_ticker = map_ticker(out_symbol, ticker)
+        if out_ticker is None:
+            result['error'] = 'Invalid ticker id in file: {}'.format(ticker)
+            return result
+
+        if force_from is not None:
+            min_dt = force_from
+        if force_to is not None:
+            max_dt = force_to
+
+        result['ticker'] = out_ticker
+        result['bars'] = len(bars)
+        result['start_time'] = min_dt
+        result['end_time'] = max_dt
+        result['payload'] = bars.buffer
+    except ValidationError as e:
+        result['error'] = 'Validation failed: {}'.format(e)
+    except (OSError, ValueError, IndexError, struct.error) as e:
+        result['error'] = str(e)
+    return result
+
+def list_input_files(input_glob):
+    if os.path.isdir(input_glob):
+        files = [os.path.join(input_glob, x) for x in os.listdir(input_glob)]
+    else:
+        files = glob.glob(input_glob, recursive=True)
+    return sorted(os.path.abspath(x) for x in files if os.path.isfile(x))
+
+class UploadStats:
+    def __init__(self, total):
+        self.total = total
+        self.files = 0
+        self.failed = 0
+        self.bars = 0
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, ok, bars):
+        with self.lock:
+            self.files += 1
+            self.bars += bars
+            if not ok:
+                self.failed += 1
+            if self.files % 100 == 0:
+                self.report()
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        print("[{}/{}] failed: {}, {:.1f} files/s, {:.0f} bars/s".format(self.files, self.total, self.failed, self.files / elapsed, self.bars / elapsed))
+
+def upload_params(args, period, time_delta):
+    # Part of every file's fingerprint: a rerun with other settings uploads again
+    return { 'hap' : args.hap, 'symbol' : args.hap_symbol, 'timeframe' : period, 'timezone' : args.timezone,
+            'time_delta' : int(time_delta.total_seconds()), 'force_from' : args.force_from, 'force_to' : args.force_to,
+            'validation' : args.validation }
+
+def bulk_upload(args, period, time_delta):
+    files = list_input_files(args.input_glob)
+    params = upload_params(args, period, time_delta)
+    with Manifest(args.manifest) as manifest:
+        pending = []
+        for filename in files:
+            fp = { 'file' : fingerprint(filename), 'params' : params }
+            if not manifest.is_done(filename, fp):
+                pending.append((filename, fp))
 
-    rq = {
-        "ticker" : out_ticker,
-        "start_time" : min_dt.strftime("%Y-%m-%dT%H:%M:%S"),
-        "end_time" : max_dt.strftime("%Y-%m-%dT%H:%M:%S"),
-        "timeframe_sec" : sec_from_period(period)
-    }
+        print("Found {} files, {} already uploaded".format(len(files), len(files) - len(pending)))
+        if len(pending) == 0:
+            return True
+
+        stats = UploadStats(len(pending))
+
+        # Parsed payloads held in memory at once: a slot is taken before a file
+        # is handed to the pool and given back once HAP has acknowledged it
+        window = threading.BoundedSemaphore(UPLOAD_WINDOW * (args.jobs or os.cpu_count() or 1))
+
+        def uploaded(job):
+            def done(ok, parts):
+                window.release()
+                if ok:
+                    manifest.record(job['file'], job['fingerprint'], 'ok', ticker=job['ticker'], bars=job['bars'])
+                    stats.add(True, job['bars'])
+                else:
+                    manifest.record(job['file'], job['fingerprint'], 'failed', ticker=job['ticker'], error=repr(parts))
+                    stats.add(False, 0)
+                    print("Upload failed: {}: {}".format(job['file'], parts))
+            return done
+
+        fingerprints = dict(pending)
+        prepare = functools.partial(prepare_file, timezone=args.timezone, time_delta=time_delta, out_symbol=args.hap_symbol,
+                force_from=parse_date(args.force_from), force_to=parse_date(args.force_to),
+                timeframe_sec=sec_from_period(period), validation=args.validation)
+        with HapClient(args.hap, args.connections, args.hap_timeout) as hap:
+            def prepared(result):
+                # Runs on the pool's result thread
+                result['fingerprint'] = fingerprints[result['file']]
+                if 'error' not in result:
+                    try:
+                        hap.upload(result['ticker'], [result['payload']], period, result['start_time'], result['end_time'], callback=uploaded(result))
+                        return
+                    except ValueError as e:
+                        result['error'] = str(e)
+                window.release()
+                manifest.record(result['file'], result['fingerprint'], 'failed', error=result['error'])
+                stats.add(False, 0)
+                print("Parse failed: {}: {}".format(result['file'], result['error']))
+
+            def crashed(filename, e):
+                prepared({ 'file' : filename, 'bars' : 0, 'error' : repr(e) })
+
+            profiling.mark_partial('CSV parsing runs in unprofiled worker processes')
+            with multiprocessing.Pool(args.jobs, initializer=profiling.detach) as pool:
+                for filename, fp in pending:
+                    window.acquire()
+                    pool.apply_async(prepare, (filename,), callback=prepared, error_callback=functools.partial(crashed, filename))
+                pool.close()
+                pool.join()
+
+        stats.report()
+        return stats.failed == 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Finam quote downloader')
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('-i', '--input-file', action='store', dest='input_file', help='Input filename')
+    inputs.add_argument('-I', '--input-glob', action='store', dest='input_glob', help='Input directory or glob pattern (bulk mode)')
+    parser.add_argument('-p', '--timeframe', action='store', dest='timeframe', help='Data timeframe', required=True)
+    parser.add_argument('-o', '--hap', action='store', dest='hap', help='HAP endpoints: comma-separated shards, \'|\'-separated replicas', required=True)
+    parser.add_argument('-y', '--hap-symbol', action='store', dest='hap_symbol', help='HAP symbol', required=True)
+    parser.add_argument('-d', '--time-delta', action='store', dest='time_delta', help='Time delta (seconds)')
+    parser.add_argument('-f', '--force-from', action='store', dest='force_from', help='Force period start')
+    parser.add_argument('-t', '--force-to', action='store', dest='force_to', help='Force period end')
+    parser.add_argument('-z', '--timezone', action='store', dest='timezone', help='Timestamps timezone')
+    parser.add_argument('-j', '--jobs', action='store', dest='jobs', type=int, help='Parser processes in bulk mode')
+    parser.add_argument('-n', '--connections', action='store', dest='connections', type=int, default=2, help='Connections per HAP shard in bulk mode')
+    parser.add_argument('--hap-timeout', action='store', dest='hap_timeout', type=float, default=300, help='HAP acknowledgement timeout before failover (seconds)')
+    parser.add_argument('-m', '--manifest', action='store', dest='manifest', default='hap_csv_upload.manifest', help='Bulk mode manifest file')
+    parser.add_argument('--validate', action='store', dest='validation', choices=POLICIES, help='Check bars before upload: reject, repair (sort, drop duplicate timestamps), drop (repair and drop invalid bars) or report')
+    parser.add_argument('--profile', action='store', dest='profile', help='Write profiling report to file')
+
+
+    args = parser.parse_args()
+    profiling.start(args.profile)
+
+    period = args.timeframe
+
+    time_delta = datetime.timedelta(hours=0)
+    if args.time_delta is not None:
+        time_delta = datetime.timedelta(seconds=int(args.time_delta))
+        print('Applying delta:', time_delta)
+
+    if args.input_glob is not None:
+        if bulk_upload(args, period, time_delta):
+            return True
+        return None
+
+    tz = get_timezone(args.timezone)
+
+    out_symbol = args.hap_symbol
+
+    bar_format = BAR_FORMAT if args.validation is None else PARSED_BAR_FORMAT
+    try:
+        ticker, bars, min_dt, max_dt, line_count = read_bars(args.input_file, tz, time_delta, bar_format)
+    except (ValueError, struct.error) as e:
+        print("Parse failed:", e)
+        return None
+
+    if args.force_from is not None:
+        min_dt = parse_date(args.force_from)
+
+    if args.force_to is not None:
+        max_dt = parse_date(args.force_to)
+
+    out_ticker = map_ticker(out_symbol, ticker)
+    if out_ticker is None:
+        print('Invalid ticker id in file')
+        return
+
+    if out_symbol[0] == '~':
+        print("Resulting ticker: {}".format(out_ticker))
 
     print("Read {} lines".format(line_count))
-    raw_data = serialized_bars.getvalue()
-    print("Sending {} bytes".format(len(raw_data)))
+    print("Sending {} bytes".format(len(bars.buffer)))
 
-    s.send_multipart([bytes(json.dumps(rq), "utf-8"), raw_data])
-    parts = s.recv_multipart()
-    print("Response:", parts)
+    with HapClient(args.hap, timeout=args.hap_timeout, validation=args.validation) as hap:
+        try:
+            hap.upload(out_ticker, [bars], period, min_dt, max_dt, callback=lambda ok, parts: print("Response:", parts))
+        except ValidationError as e:
+            print("Validation failed:", e)
+            return None
+        except ValueError as e:
+            print("Upload failed:", e)
+            return None
     return True
 
 
@@ -166,4 +322,3 @@ if __name__ == '__main__':
     if ret is None:
         sys.exit(1)
     
-
@@ -0,0 +1,3 @@
+from mdstools.bars import BarAggregator, BarSeries
+from mdstools.hap import HapClient
+from mdstools.qhp import QhpClient, QhpError
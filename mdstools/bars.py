@@ -0,0 +1,177 @@
+import array
+import bisect
+import datetime
+import itertools
+import operator
+import struct
+
+# Wire format shared by QHP and HAP: timestamp, open, high, low, close, volume.
+# Column views below rely on the host being little-endian like the wire.
+BAR_FORMAT = "<qddddQ"
+BAR_SIZE = struct.calcsize(BAR_FORMAT)
+BAR_FIELDS = 6
+# Same layout with signed volume, used by text parsers so that negative volumes
+# can be packed and caught by validation instead of failing in struct
+PARSED_BAR_FORMAT = "<qddddq"
+
+
+class BarSeries:
+    __slots__ = ('buffer', 'timestamps', 'opens', 'highs', 'lows', 'closes', 'volumes')
+
+    def __init__(self, buffer=b''):
+        if len(buffer) % BAR_SIZE != 0:
+            raise ValueError('Buffer size is not a multiple of {}'.format(BAR_SIZE))
+        # Columns are strided views into the buffer, nothing is copied
+        self.buffer = buffer
+        view = memoryview(buffer)
+        ints = view.cast('q')
+        floats = view.cast('d')
+        self.timestamps = ints[0::BAR_FIELDS]
+        self.opens = floats[1::BAR_FIELDS]
+        self.highs = floats[2::BAR_FIELDS]
+        self.lows = floats[3::BAR_FIELDS]
+        self.closes = floats[4::BAR_FIELDS]
+        self.volumes = view.cast('Q')[5::BAR_FIELDS]
+
+    def release(self):
+        # Drops the column views so that an mmap-backed buffer can be closed
+        for column in (self.timestamps, self.opens, self.highs, self.lows, self.closes, self.volumes):
+            column.release()
+
+    @classmethod
+    def from_rows(cls, rows):
+        data = bytearray()
+        pack = struct.Struct(BAR_FORMAT).pack
+        for row in rows:
+            data += pack(*row)
+        return cls(data)
+
+    @classmethod
+    def concat(cls, series):
+        buffers = [x.buffer for x in series if len(x) > 0]
+        if len(buffers) == 1:
+            return cls(buffers[0])
+        return cls(b''.join(buffers))
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('Only contiguous slices are supported')
+            stop = max(start, stop)
+            return BarSeries(memoryview(self.buffer)[start * BAR_SIZE:stop * BAR_SIZE])
+        n = len(self)
+        if index < 0:
+            index += n
+        if index < 0 or index >= n:
+            raise IndexError('BarSeries index out of range')
+        return struct.unpack_from(BAR_FORMAT, self.buffer, index * BAR_SIZE)
+
+    def rows(self):
+        return struct.iter_unpack(BAR_FORMAT, self.buffer)
+
+    def is_sorted(self):
+        ts = self.timestamps
+        return all(map(operator.lt, ts[:-1], ts[1:]))
+
+    def slice_time(self, start=None, end=None):
+        # Bars with start <= timestamp < end; series has to be sorted
+        lo = 0
+        hi = len(self)
+        if start is not None:
+            lo = bisect.bisect_left(self.timestamps, start)
+        if end is not None:
+            hi = bisect.bisect_left(self.timestamps, end, lo)
+        return self[lo:hi]
+
+    def dedup(self):
+        # Sorts by timestamp, the last bar wins for duplicate timestamps
+        if self.is_sorted():
+            return self
+        ts = self.timestamps
+        order = sorted(range(0, len(self)), key=ts.__getitem__)
+        view = memoryview(self.buffer)
+        data = bytearray()
+        for n, i in enumerate(order):
+            if n + 1 < len(order) and ts[order[n + 1]] == ts[i]:
+                continue
+            data += view[i * BAR_SIZE:(i + 1) * BAR_SIZE]
+        return BarSeries(data)
+
+    def shift(self, seconds):
+        if seconds == 0:
+            return self
+        data = array.array('q')
+        data.frombytes(self.buffer)
+        data[0::BAR_FIELDS] = array.array('q', [x + seconds for x in data[0::BAR_FIELDS]])
+        return BarSeries(data.tobytes())
+
+    def adjust(self, offset=0.0, factor=1.0):
+        # price * factor + offset for open, high, low and close
+        if offset == 0.0 and factor == 1.0:
+            return self
+        data = array.array('d')
+        data.frombytes(self.buffer)
+        n = len(self)
+        for i in range(1, 5):
+            prices = data[i::BAR_FIELDS]
+            if factor != 1.0:
+                prices = map(operator.mul, prices, itertools.repeat(factor, n))
+            if offset != 0.0:
+                prices = map(operator.add, prices, itertools.repeat(offset, n))
+            data[i::BAR_FIELDS] = array.array('d', prices)
+        return BarSeries(data.tobytes())
+
+
+class BarAggregator:
+    def __init__(self, timeframe):
+        self.open_ = 0
+        self.high = 0
+        self.low = 0
+        self.close = 0
+        self.volume = 0
+        self.timestamp = None
+        self.current_bar_number = None
+        self.timeframe = timeframe
+
+    def push_bar(self, timestamp, open_, high, low, close, volume):
+        bar_number = timestamp.timestamp() // self.timeframe
+        if bar_number != self.current_bar_number:
+            b_open = self.open_
+            b_high = self.high
+            b_low = self.low
+            b_close = self.close
+            b_volume = self.volume
+            if self.current_bar_number is not None:
+                b_timestamp = datetime.datetime.fromtimestamp(self.current_bar_number * self.timeframe)
+
+            self.open_ = open_
+            self.high = high
+            self.low = low
+            self.close = close
+            self.volume = volume
+            self.timestamp = timestamp
+            prev_bar_number = self.current_bar_number
+            self.current_bar_number = bar_number
+
+            if prev_bar_number is not None:
+                return (b_timestamp, b_open, b_high, b_low, b_close, b_volume)
+        else:
+            self.high = max(high, self.high)
+            self.low = min(low, self.low)
+            self.close = close
+            self.volume += volume
+            return None
+
+    def get_bar(self):
+        b_open = self.open_
+        b_high = self.high
+        b_low = self.low
+        b_close = self.close
+        b_volume = self.volume
+        b_timestamp = datetime.datetime.fromtimestamp(self.timeframe * ( self.timestamp.timestamp() // self.timeframe))
+
+        return (b_timestamp, b_open, b_high, b_low, b_close, b_volume)
@@ -0,0 +1,74 @@
+import re
+
+REGEX_CHARS = set('.^$*+?{}[]\\|()')
+GLOBAL_FLAGS = re.compile(r'^\(\?[aiLmsux]+\)')
+# Numbered backreferences and group conditionals; combining rules renumbers groups
+NUMBERED_REFS = re.compile(r'\\[1-9]|\(\?\(\d')
+
+
+class Blacklist:
+    # Rules are matched at the start of the ticker like re.match. Plain
+    # literal rules go into a prefix trie, the rest into one combined regex.
+    def __init__(self, rules):
+        self.trie = {}
+        self.regex = None
+        self.patterns = []
+        other = []
+        for rule in rules:
+            if GLOBAL_FLAGS.match(rule) or NUMBERED_REFS.search(rule):
+                # Global inline flags and group numbers do not survive
+                # being part of a combined pattern
+                self.patterns.append(re.compile(rule))
+            elif any(c in REGEX_CHARS for c in rule):
+                other.append(rule)
+            else:
+                self.add_prefix(rule)
+
+        if len(other) > 0:
+            try:
+                self.regex = re.compile('|'.join('(?:{})'.format(x) for x in other))
+            except re.error:
+                self.patterns += [re.compile(x) for x in other]
+
+    def add_prefix(self, prefix):
+        node = self.trie
+        for c in prefix:
+            node = node.setdefault(c, {})
+        node[None] = True
+
+    def match_prefix(self, ticker):
+        node = self.trie
+        if None in node:
+            return True
+        for c in ticker:
+            node = node.get(c)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def match(self, ticker):
+        if self.match_prefix(ticker):
+            return True
+        if self.regex is not None and self.regex.match(ticker):
+            return True
+        for rx in self.patterns:
+            if rx.match(ticker):
+                return True
+        return False
+
+
+def load_blacklist(filename):
+    rules = []
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line != "":
+                rules.append(line)
+
+    return Blacklist(rules)
+
+
+def allow_ticker(blacklist, ticker):
+    return blacklist is None or not blacklist.match(ticker)
@@ -0,0 +1,46 @@
+import json
+import os
+import time
+
+
+class TickerCatalog:
+    def __init__(self, filename, ttl):
+        self.filename = filename
+        self.ttl = ttl
+        self.tickers = []
+        self.updated = None
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                data = json.load(f)
+            self.tickers = data['tickers']
+            self.updated = data['updated']
+
+    def is_fresh(self):
+        return self.updated is not None and time.time() - self.updated < self.ttl
+
+    def update(self, fetch, force=False):
+        # Returns (tickers, added, removed) relative to the stored snapshot;
+        # call save() once the changes have been processed
+        if self.is_fresh() and not force:
+            return self.tickers, [], []
+        tickers = fetch()
+        old = set(self.tickers)
+        new = set(tickers)
+        added = [x for x in tickers if x not in old]
+        removed = [x for x in self.tickers if x not in new]
+        self.tickers = tickers
+        self.updated = time.time()
+        return tickers, added, removed
+
+    def forget(self, tickers):
+        # Forgotten tickers show up as added again on the next update, which
+        # has to fetch a fresh list since the stored one is now incomplete
+        forgotten = set(tickers)
+        self.tickers = [x for x in self.tickers if x not in forgotten]
+        self.updated = None
+
+    def save(self):
+        tmp_name = self.filename + '.tmp'
+        with open(tmp_name, 'w') as f:
+            json.dump({ 'updated' : self.updated, 'tickers' : self.tickers }, f)
+        os.replace(tmp_name, self.filename)
@@ -0,0 +1,109 @@
+import gzip
+import io
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def get_codec(filename):
+    if filename.endswith('.gz'):
+        return 'gzip'
+    elif filename.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError('zstandard module is required for .zst files')
+        return 'zstd'
+    return None
+
+
+def compress_block(codec, data):
+    # Every block becomes a standalone gzip member/zstd frame, so blocks
+    # can be compressed in parallel and simply concatenated.
+    if codec == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+
+class CompressedWriter:
+    def __init__(self, filename, codec, block_size=BLOCK_SIZE, threads=None):
+        if threads is None:
+            threads = min(4, os.cpu_count() or 1)
+        self.codec = codec
+        self.block_size = block_size
+        self.buffer = []
+        self.buffered = 0
+        self.error = None
+        self.f = open(filename, 'wb')
+        self.pool = ThreadPoolExecutor(threads)
+        self.pending = queue.Queue(maxsize=threads * 4)
+        self.writer = threading.Thread(target=self.write_loop)
+        self.writer.start()
+
+    def write(self, s):
+        self.buffer.append(s)
+        self.buffered += len(s)
+        if self.buffered >= self.block_size:
+            self.submit()
+        return len(s)
+
+    def submit(self):
+        if self.buffered == 0:
+            return
+        data = ''.join(self.buffer).encode('utf-8')
+        self.buffer = []
+        self.buffered = 0
+        self.pending.put(self.pool.submit(compress_block, self.codec, data))
+
+    def write_loop(self):
+        while True:
+            future = self.pending.get()
+            if future is None:
+                break
+            try:
+                block = future.result()
+                if self.error is None:
+                    self.f.write(block)
+            except Exception as e:
+                # Keep draining so the producer never blocks on a full queue
+                self.error = e
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.submit()
+        self.pending.put(None)
+        self.writer.join()
+        self.pool.shutdown()
+        self.f.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_output(filename):
+    codec = get_codec(filename)
+    if codec is None:
+        return open(filename, 'w', newline='')
+    return CompressedWriter(filename, codec)
+
+
+def open_input(filename):
+    codec = get_codec(filename)
+    if codec == 'gzip':
+        return gzip.open(filename, 'rt', newline='')
+    elif codec == 'zstd':
+        reader = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), read_across_frames=True, closefd=True)
+        return io.TextIOWrapper(io.BufferedReader(reader, BLOCK_SIZE), encoding='utf-8', newline='')
+    return open(filename, 'r', newline='')
@@ -0,0 +1,125 @@
+import queue
+import threading
+import time
+
+import zmq
+
+
+class AimdController:
+    def __init__(self, initial=2, minimum=1, maximum=16, backoff=0.5, latency_factor=4.0):
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.latency_factor = latency_factor
+        self.in_flight = 0
+        self.min_latency = None
+        self.latency = None
+        self.last_decrease = 0
+        self.errors = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency, ok):
+        with self.cond:
+            self.in_flight -= 1
+            if ok:
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency = 0.8 * self.latency + 0.2 * latency
+                # Hold the window while replies are much slower than the best seen
+                if latency <= self.latency_factor * self.min_latency:
+                    self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            else:
+                self.errors += 1
+                self.decrease()
+            self.cond.notify_all()
+
+    def decrease(self):
+        # At most one multiplicative decrease per round trip, so a burst of
+        # failures from the same window does not collapse the limit
+        now = time.monotonic()
+        if self.latency is not None and now - self.last_decrease < self.latency:
+            return
+        self.limit = max(self.minimum, self.limit * self.backoff)
+        self.last_decrease = now
+
+    def status(self):
+        with self.cond:
+            latency = self.latency if self.latency is not None else 0.0
+            return "concurrency: {:.1f}, in flight: {}, latency: {:.3f} s, errors: {}".format(self.limit, self.in_flight, latency, self.errors)
+
+
+def worker(work, results, request, make_socket, controller):
+    sock = None
+    while True:
+        job = work.get()
+        if job is None:
+            break
+        item, attempt = job
+        controller.acquire()
+        start = time.monotonic()
+        try:
+            if sock is None:
+                sock = make_socket()
+            result = request(sock, item)
+        except zmq.Again:
+            # REQ socket is stuck waiting for a reply, start over with a fresh one
+            result = None
+            sock.close()
+            sock = None
+        except Exception as e:
+            # Keep the worker alive: the slot must be released and a result
+            # reported, otherwise run_adaptive waits forever
+            print("Request error: {}: {!r}".format(item, e))
+            result = None
+            if sock is not None:
+                sock.close()
+                sock = None
+        controller.release(time.monotonic() - start, result is not None)
+        results.put((item, attempt, result))
+    if sock is not None:
+        sock.close()
+
+
+def run_adaptive(items, request, make_socket, controller, max_retries=3):
+    work = queue.Queue()
+    results = queue.Queue()
+    threads = []
+    for i in range(0, controller.maximum):
+        t = threading.Thread(target=worker, args=(work, results, request, make_socket, controller), daemon=True)
+        t.start()
+        threads.append(t)
+
+    for item in items:
+        work.put((item, 0))
+
+    outstanding = len(items)
+    done = 0
+    try:
+        while outstanding > 0:
+            item, attempt, result = results.get()
+            if result is None and attempt + 1 < max_retries:
+                print("Request failed: {}, retry {} of {}".format(item, attempt + 1, max_retries))
+                work.put((item, attempt + 1))
+                continue
+            outstanding -= 1
+            done += 1
+            print("[{}/{}] {}".format(done, len(items), controller.status()))
+            yield item, result
+    finally:
+        while True:
+            try:
+                work.get_nowait()
+            except queue.Empty:
+                break
+        for t in threads:
+            work.put(None)
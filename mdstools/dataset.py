@@ -0,0 +1,139 @@
+import calendar
+import csv
+import datetime
+import json
+import os
+import struct
+
+from mdstools import profiling
+from mdstools.bars import BAR_FORMAT, BarSeries
+
+INDEX_FILE = 'index.json'
+FORMATS = ['bin', 'csv']
+
+
+def month_start(year, month):
+    return calendar.timegm((year, month, 1, 0, 0, 0))
+
+
+def next_month(year, month):
+    if month == 12:
+        return year + 1, 1
+    return year, month + 1
+
+
+def write_atomic(filename, write, binary=False):
+    tmp_name = filename + '.tmp'
+    if binary:
+        f = open(tmp_name, 'wb')
+    else:
+        f = open(tmp_name, 'w', newline='')
+    with f:
+        write(f)
+    os.replace(tmp_name, filename)
+
+
+class Dataset:
+    # root/timeframe/ticker/YYYY/MM/bars.<fmt> plus root/timeframe/ticker/index.json
+    # with the time range and row count of every partition
+    def __init__(self, root, timeframe, fmt='bin'):
+        if fmt not in FORMATS:
+            raise ValueError('Invalid dataset format: {}'.format(fmt))
+        self.root = root
+        self.timeframe = timeframe
+        self.fmt = fmt
+
+    def ticker_dir(self, ticker):
+        return os.path.join(self.root, self.timeframe, ticker.replace(os.sep, '_'))
+
+    def tickers(self):
+        path = os.path.join(self.root, self.timeframe)
+        if not os.path.isdir(path):
+            return []
+        return sorted(x for x in os.listdir(path) if os.path.exists(os.path.join(path, x, INDEX_FILE)))
+
+    def load_index(self, ticker):
+        filename = os.path.join(self.ticker_dir(ticker), INDEX_FILE)
+        if not os.path.exists(filename):
+            return { 'format' : self.fmt, 'partitions' : {} }
+        with open(filename, 'r') as f:
+            return json.load(f)
+
+    def save_index(self, ticker, index):
+        write_atomic(os.path.join(self.ticker_dir(ticker), INDEX_FILE), lambda f: json.dump(index, f, indent=1, sort_keys=True))
+
+    def partition_file(self, ticker, key, fmt):
+        year, month = key.split('-')
+        return os.path.join(self.ticker_dir(ticker), year, month, 'bars.' + fmt)
+
+    def read_partition(self, ticker, key, fmt):
+        filename = self.partition_file(ticker, key, fmt)
+        if fmt == 'bin':
+            with open(filename, 'rb') as f:
+                return BarSeries(f.read())
+
+        data = bytearray()
+        pack = struct.Struct(BAR_FORMAT).pack
+        with open(filename, 'r', newline='') as f:
+            reader = csv.reader(f)
+            next(reader)
+            for line in reader:
+                data += pack(int(line[0]), float(line[1]), float(line[2]), float(line[3]), float(line[4]), int(line[5]))
+        return BarSeries(data)
+
+    def write_partition(self, ticker, key, fmt, bars):
+        filename = self.partition_file(ticker, key, fmt)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        if fmt == 'bin':
+            write_atomic(filename, lambda f: f.write(bars.buffer), binary=True)
+            return
+
+        def write_csv(f):
+            writer = csv.writer(f)
+            writer.writerow(['<TIMESTAMP>', '<OPEN>', '<HIGH>', '<LOW>', '<CLOSE>', '<VOLUME>'])
+            writer.writerows(bars.rows())
+        write_atomic(filename, write_csv)
+
+    def write(self, ticker, bars):
+        # Only partitions touched by the new bars are rewritten; new bars
+        # replace stored bars with the same timestamp
+        bars = bars.dedup()
+        if len(bars) == 0:
+            return
+        index = self.load_index(ticker)
+        fmt = index['format']
+        first = datetime.datetime.utcfromtimestamp(bars.timestamps[0])
+        year, month = first.year, first.month
+        with profiling.section('write'):
+            while True:
+                start = month_start(year, month)
+                if start > bars.timestamps[-1]:
+                    break
+                year_next, month_next = next_month(year, month)
+                part = bars.slice_time(start, month_start(year_next, month_next))
+                if len(part) > 0:
+                    key = '{:04d}-{:02d}'.format(year, month)
+                    if key in index['partitions']:
+                        part = BarSeries.concat([self.read_partition(ticker, key, fmt), part]).dedup()
+                    self.write_partition(ticker, key, fmt, part)
+                    index['partitions'][key] = { 'start' : part.timestamps[0], 'end' : part.timestamps[-1], 'rows' : len(part) }
+                year, month = year_next, month_next
+        self.save_index(ticker, index)
+
+    def last_timestamp(self, ticker):
+        partitions = self.load_index(ticker)['partitions']
+        if len(partitions) == 0:
+            return None
+        return max(x['end'] for x in partitions.values())
+
+    def read(self, ticker, start=None, end=None):
+        # Yields one BarSeries per partition overlapping [start, end)
+        index = self.load_index(ticker)
+        for key, part in sorted(index['partitions'].items()):
+            if start is not None and part['end'] < start:
+                continue
+            if end is not None and part['start'] >= end:
+                continue
+            with profiling.section('read'):
+                bars = self.read_partition(ticker, key, index['format'])
+            yield bars.slice_time(start, end)
@@ -0,0 +1,87 @@
+import bisect
+
+MONTH_CODES = ['F', 'G', 'H', 'J', 'K', 'M', 'N', 'Q', 'U', 'V', 'X', 'Z']
+
+ADJUST_METHODS = ['difference', 'ratio']
+
+
+def get_month_code(month):
+    if month < 1 or month > 12:
+        return None
+    return MONTH_CODES[month - 1]
+
+
+def get_month_by_code(code):
+    try:
+        mon = MONTH_CODES.index(code)
+    except ValueError:
+        return None
+    return mon + 1
+
+
+def make_tickers_list(base, start_time, end_time, futures_interval):
+    result = []
+    month = start_time.date().month
+    year = start_time.date().year
+
+    while True:
+        if month % futures_interval == 0:
+            result.append(base + '-' + str(month) + '.' + str(year)[-2:])
+            if month > end_time.date().month and year >= end_time.date().year:
+                break
+
+        month += 1
+        if month > 12:
+            month = 1
+            year += 1
+
+    return result
+
+
+def convert_ticker(s, last_dt):
+    if s.startswith("SPBFUT#"):
+        year = int(s[-1])
+        current_year = last_dt.date().year - 2000
+        current_year_in_dec = current_year % 10
+        current_dec = current_year - current_year_in_dec
+        mon = get_month_by_code(s[-2])
+        if year >= current_year_in_dec:
+            return s[:-2] + ".{}-{}".format(mon, current_dec + year)
+        else:
+            return s[:-2] + ".{}-{}".format(mon, current_dec + 10 + year)
+            
+    else:
+        return s
+
+
+def roll_prices(old_bars, new_bars):
+    # Closes of both contracts at the last bar of the expiring one; new_bars
+    # must not be cut yet so that it still overlaps old_bars
+    ts = old_bars.timestamps[-1]
+    i = bisect.bisect_right(new_bars.timestamps, ts)
+    if i > 0:
+        return old_bars.closes[-1], new_bars.closes[i - 1]
+    return old_bars.closes[-1], new_bars.opens[0]
+
+
+def back_adjustments(rolls, method):
+    # rolls[i] is (old_close, new_close) for the roll into contract i, or None.
+    # Returns (offset, factor) per contract, accumulated from the latest one
+    # backwards so that the last contract keeps its prices
+    if method not in ADJUST_METHODS:
+        raise ValueError('Invalid adjustment method: {}'.format(method))
+    offset = 0.0
+    factor = 1.0
+    result = [None] * len(rolls)
+    for i in reversed(range(len(rolls))):
+        result[i] = (offset, factor)
+        if rolls[i] is None:
+            continue
+        old_close, new_close = rolls[i]
+        if method == 'difference':
+            offset += new_close - old_close
+        else:
+            if old_close <= 0 or new_close <= 0:
+                raise ValueError('Ratio adjustment requires positive prices')
+            factor *= new_close / old_close
+    return result
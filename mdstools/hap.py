@@ -0,0 +1,198 @@
+import bisect
+import datetime
+import hashlib
+import json
+import queue
+import threading
+
+import zmq
+
+from mdstools import profiling
+from mdstools.bars import BarSeries
+from mdstools.timeframes import sec_from_period
+from mdstools.validation import validate_series
+
+
+def parse_endpoints(spec):
+    # "tcp://a:5555|tcp://a-replica:5555,tcp://b:5555" -> one shard per
+    # comma-separated item, replicas of a shard separated by '|'
+    result = []
+    for shard in spec.split(','):
+        endpoints = [x.strip() for x in shard.split('|') if x.strip() != ""]
+        if len(endpoints) > 0:
+            result.append(endpoints)
+    if len(result) == 0:
+        raise ValueError('No HAP endpoints given')
+    return result
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.md5(bytes(key, 'utf-8')).digest()[:8], 'little')
+
+
+class HashRing:
+    def __init__(self, nodes, vnodes=128):
+        self.ring = []
+        for node in nodes:
+            for i in range(0, vnodes):
+                self.ring.append((hash_key("{}#{}".format(node, i)), node))
+        self.ring.sort()
+        self.keys = [x[0] for x in self.ring]
+
+    def get(self, key):
+        pos = bisect.bisect(self.keys, hash_key(key)) % len(self.ring)
+        return self.ring[pos][1]
+
+
+class HapShard:
+    def __init__(self, endpoints, connections=1, timeout=None, queue_size=4, max_failovers=None):
+        self.endpoints = endpoints
+        self.timeout = timeout
+        # Without replicas there is nothing to fail over to: reconnect and fail
+        if max_failovers is None:
+            max_failovers = 2 * len(endpoints) if len(endpoints) > 1 else 0
+        self.max_failovers = max_failovers
+        self.jobs = queue.Queue(maxsize=queue_size * connections)
+        self.current = 0
+        self.lock = threading.Lock()
+        self.threads = []
+        for i in range(0, connections):
+            t = threading.Thread(target=self.run, daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def connect(self):
+        with self.lock:
+            endpoint = self.endpoints[self.current]
+        s = zmq.Context.instance().socket(zmq.REQ)
+        s.setsockopt(zmq.LINGER, 0)
+        if self.timeout is not None:
+            s.setsockopt(zmq.RCVTIMEO, int(self.timeout * 1000))
+        s.connect(endpoint)
+        return s, endpoint
+
+    def failover(self, endpoint):
+        if len(self.endpoints) == 1:
+            return
+        with self.lock:
+            # Other connections may have already moved on
+            if self.endpoints[self.current] == endpoint:
+                self.current = (self.current + 1) % len(self.endpoints)
+                print("HAP {} is not responding, switching to {}".format(endpoint, self.endpoints[self.current]))
+
+    def send(self, s, endpoint, request, payload):
+        parts = None
+        for attempt in range(0, self.max_failovers + 1):
+            try:
+                with profiling.section('zmq_send'):
+                    s.send_multipart([request, payload], copy=False)
+                with profiling.section('zmq_recv'):
+                    parts = s.recv_multipart()
+                break
+            except zmq.Again:
+                s.close()
+                self.failover(endpoint)
+                s, endpoint = self.connect()
+        return s, endpoint, parts
+
+    def run(self):
+        s, endpoint = self.connect()
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            request, payload, callback = job
+            try:
+                s, endpoint, parts = self.send(s, endpoint, request, payload)
+            except Exception as e:
+                # The REQ socket may be left mid-request; reconnect so the
+                # thread keeps draining the queue
+                print("HAP {} request error: {!r}".format(endpoint, e))
+                parts = [b'ERROR', bytes(repr(e), 'utf-8')]
+                s.close()
+                s, endpoint = self.connect()
+            if callback is not None:
+                try:
+                    callback(parts is not None and parts[0] == b'OK', parts)
+                except Exception as e:
+                    print("HAP upload callback failed: {!r}".format(e))
+        s.close()
+
+    def close(self):
+        for t in self.threads:
+            self.jobs.put(None)
+        for t in self.threads:
+            t.join()
+
+
+class ShardedUploader:
+    def __init__(self, shards, connections=1, timeout=None, queue_size=4):
+        # Shards are keyed by their primary endpoint, so the ticker placement
+        # does not depend on the order in which shards are listed
+        self.shards = {}
+        for endpoints in shards:
+            self.shards[endpoints[0]] = HapShard(endpoints, connections, timeout, queue_size)
+        self.ring = HashRing(list(self.shards.keys()))
+
+    def submit(self, ticker, request, payload, callback=None):
+        # Blocks while the shard's queue is full
+        self.shards[self.ring.get(ticker)].jobs.put((request, payload, callback))
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class HapClient:
+    def __init__(self, endpoints, connections=1, timeout=None, queue_size=4, validation=None):
+        if isinstance(endpoints, str):
+            endpoints = parse_endpoints(endpoints)
+        self.uploader = ShardedUploader(endpoints, connections, timeout, queue_size)
+        self.validation = validation
+
+    def upload(self, ticker, chunks, period, start_time=None, end_time=None, tz=datetime.timezone.utc, callback=None):
+        # Accepts any iterable of BarSeries or raw bar buffers; payloads are
+        # concatenated once and sent as a single message
+        buffers = []
+        with profiling.section('encode'):
+            for chunk in chunks:
+                if isinstance(chunk, BarSeries):
+                    chunk = chunk.buffer
+                if len(chunk) > 0:
+                    buffers.append(chunk)
+            bars = BarSeries(buffers[0] if len(buffers) == 1 else b''.join(buffers))
+
+        if len(bars) == 0:
+            raise ValueError('No bars to upload')
+        if self.validation is not None:
+            bars = validate_series(bars, sec_from_period(period), self.validation, ticker)
+            if len(bars) == 0:
+                raise ValueError('No bars to upload')
+        if start_time is None:
+            start_time = datetime.datetime.fromtimestamp(min(bars.timestamps), tz)
+        if end_time is None:
+            end_time = datetime.datetime.fromtimestamp(max(bars.timestamps), tz)
+
+        rq = {
+            "ticker" : ticker,
+            "start_time" : start_time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "end_time" : end_time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "timeframe_sec" : sec_from_period(period)
+        }
+
+        self.uploader.submit(ticker, bytes(json.dumps(rq), "utf-8"), bars.buffer, callback)
+
+    def close(self):
+        self.uploader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
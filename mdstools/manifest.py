@@ -0,0 +1,49 @@
+import json
+import os
+import threading
+
+
+def fingerprint(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+class Manifest:
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if line == "":
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn last line after an interrupted run
+                        continue
+                    self.entries[entry['key']] = entry
+        self.f = open(filename, 'a')
+
+    def is_done(self, key, fp):
+        entry = self.entries.get(key)
+        return entry is not None and entry['status'] == 'ok' and entry['fingerprint'] == fp
+
+    def record(self, key, fp, status, **kwargs):
+        entry = dict(kwargs, key=key, fingerprint=fp, status=status)
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            self.entries[key] = entry
+            self.f.write(line)
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
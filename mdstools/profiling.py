@@ -0,0 +1,146 @@
+import atexit
+import cProfile
+import contextlib
+import io
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+_active = None
+
+# Process CPU / wall time from which a run counts as CPU-bound
+CPU_BOUND_UTILISATION = 0.8
+
+
+class Profiler:
+    def __init__(self, report_file, top=25):
+        self.report_file = report_file
+        self.top = top
+        self.sections = {}
+        self.lock = threading.Lock()
+        self.profile = cProfile.Profile()
+        self.thread_profiles = []
+        self.partial = None
+        self.wall_start = None
+        self.cpu_start = None
+
+    def start(self):
+        tracemalloc.start()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self.profile.enable()
+        # cProfile only traces the thread that enabled it; worker threads
+        # started from now on get their own profile, merged in the report
+        threading.setprofile(self.start_thread)
+
+    def start_thread(self, frame, event, arg):
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ profiles all threads from the main profile already
+            return
+        with self.lock:
+            self.thread_profiles.append(profile)
+
+    def stop(self):
+        threading.setprofile(None)
+        self.profile.disable()
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        with open(self.report_file, 'w') as f:
+            self.write_report(f, wall, cpu, peak, snapshot)
+
+    @contextlib.contextmanager
+    def section(self, name):
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.thread_time() - cpu_start
+            with self.lock:
+                entry = self.sections.setdefault(name, [0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += wall
+                entry[2] += cpu
+
+    def write_report(self, f, wall, cpu, peak, snapshot):
+        f.write("Wall time: {:.3f} s\n".format(wall))
+        f.write("CPU time: {:.3f} s\n".format(cpu))
+        f.write("Peak traced memory: {:.1f} KiB\n\n".format(peak / 1024))
+
+        f.write("Sections (summed over threads):\n")
+        f.write("{:<16} {:>10} {:>12} {:>12} {:>12}\n".format('name', 'calls', 'wall, s', 'cpu, s', 'blocked, s'))
+        for name, (calls, s_wall, s_cpu) in sorted(self.sections.items()):
+            f.write("{:<16} {:>10} {:>12.3f} {:>12.3f} {:>12.3f}\n".format(name, calls, s_wall, s_cpu, max(0.0, s_wall - s_cpu)))
+        if self.partial is not None:
+            f.write("\nNo network/CPU verdict: {}\n".format(self.partial))
+        elif wall > 0:
+            # Section times are summed over overlapping threads, so the verdict
+            # compares process CPU with wall time; the GIL caps Python at one core
+            utilisation = cpu / wall
+            verdict = 'CPU-bound' if utilisation >= CPU_BOUND_UTILISATION else 'network-bound'
+            f.write("\nCPU utilisation: {:.0%} of one core => {}\n".format(utilisation, verdict))
+
+        f.write("\nTop allocation sites:\n")
+        for stat in snapshot.statistics('lineno')[:self.top]:
+            f.write("{}\n".format(stat))
+
+        f.write("\ncProfile (cumulative):\n")
+        out = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=out)
+        with self.lock:
+            for profile in self.thread_profiles:
+                stats.add(profile)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        f.write(out.getvalue())
+
+
+def start(report_file):
+    global _active
+    if report_file is None:
+        return
+    _active = Profiler(report_file)
+    _active.start()
+    atexit.register(stop)
+
+
+def stop():
+    global _active
+    if _active is None:
+        return
+    profiler = _active
+    _active = None
+    profiler.stop()
+    print("Profile report written to {}".format(profiler.report_file))
+
+
+def detach():
+    # Forked workers inherit the parent's profiler; drop it there
+    global _active
+    if _active is None:
+        return
+    threading.setprofile(None)
+    _active.profile.disable()
+    tracemalloc.stop()
+    _active = None
+
+
+def mark_partial(reason):
+    # Work done outside this process is missing from the report
+    if _active is not None:
+        _active.partial = reason
+
+
+def section(name):
+    if _active is None:
+        return contextlib.nullcontext()
+    return _active.section(name)
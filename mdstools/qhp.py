@@ -0,0 +1,137 @@
+import json
+
+import zmq
+
+from mdstools import profiling
+from mdstools.bars import BarSeries
+
+BATCH_MARKER = b'BATCH'
+# Error text of a QHP that does not know the request type
+INVALID_REQUEST = 'Invalid request'
+
+
+class QhpError(Exception):
+    pass
+
+
+class BatchNotSupported(Exception):
+    pass
+
+
+class QhpClient:
+    def __init__(self, endpoint, timeout=None):
+        self.socket = zmq.Context.instance().socket(zmq.REQ)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        if timeout is not None:
+            self.socket.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
+        self.socket.connect(endpoint)
+
+    def close(self):
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def request(self, rq):
+        with profiling.section('zmq_send'):
+            self.socket.send_multipart([bytes(json.dumps(rq), "utf-8")])
+        with profiling.section('zmq_recv'):
+            return self.socket.recv()
+
+    def has_more(self):
+        return self.socket.getsockopt(zmq.RCVMORE) != 0
+
+    def drain(self):
+        while self.has_more():
+            self.socket.recv()
+
+    def error(self):
+        errmsg = ''
+        if self.has_more():
+            errmsg = self.socket.recv_string()
+        self.drain()
+        return QhpError(errmsg)
+
+    def request_ticker_list(self):
+        resp = self.request({ "get_sec_list" : True })
+        if resp != b'OK':
+            raise self.error()
+
+        rawdata = b''
+        while self.has_more():
+            rawdata += self.socket.recv()
+
+        return rawdata.decode('utf-8').split(',')
+
+    def iter_data(self, ticker, start_time, end_time, period, time_delta=0):
+        # Chunks are read off the socket as the caller iterates; the
+        # generator has to be exhausted (or closed) before the next request
+        rq = {
+            "ticker" : ticker,
+            "from" : start_time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "to" : end_time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "timeframe" : period
+        }
+
+        resp = self.request(rq)
+        if resp != b'OK':
+            raise self.error()
+
+        try:
+            while self.has_more():
+                with profiling.section('zmq_recv'):
+                    rawdata = self.socket.recv()
+                with profiling.section('decode'):
+                    chunk = BarSeries(rawdata).shift(time_delta)
+                yield chunk
+        finally:
+            self.drain()
+
+    def get_data_batch(self, tickers, start_time, end_time, period, max_bars=None, time_delta=0):
+        rq = {
+            "tickers" : list(tickers),
+            "from" : start_time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "to" : end_time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "timeframe" : period
+        }
+        if max_bars is not None:
+            rq["max_bars"] = max_bars
+
+        resp = self.request(rq)
+        if resp != b'OK':
+            # Only a peer that does not understand the request lacks batching;
+            # anything else is a regular error for the caller to retry
+            error = self.error()
+            if str(error) == INVALID_REQUEST:
+                raise BatchNotSupported()
+            raise error
+
+        marker = None
+        if self.has_more():
+            marker = self.socket.recv()
+        if marker != BATCH_MARKER:
+            self.drain()
+            raise BatchNotSupported()
+
+        # Reply is a sequence of (tag, bars) frame pairs, one pair per ticker
+        result = {}
+        deferred = []
+        while self.has_more():
+            with profiling.section('zmq_recv'):
+                tag = json.loads(self.socket.recv())
+                rawdata = self.socket.recv()
+            ticker = tag['ticker']
+            if tag['status'] == 'OK':
+                with profiling.section('decode'):
+                    result[ticker] = [BarSeries(rawdata).shift(time_delta)]
+            else:
+                deferred.append(ticker)
+
+        for ticker in tickers:
+            if ticker not in result and ticker not in deferred:
+                deferred.append(ticker)
+
+        return result, deferred
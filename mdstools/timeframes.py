@@ -0,0 +1,14 @@
+TIMEFRAMES = {
+    'M1' : 60,
+    'M5' : 5 * 60,
+    'M15' : 15 * 60,
+    'M30' : 30 * 60,
+    'H1' : 60 * 60,
+    'D' : 86400,
+    'W' : 7 * 86400,
+}
+
+
+def sec_from_period(period):
+    # None for timeframes without a fixed length in seconds
+    return TIMEFRAMES.get(period)
@@ -0,0 +1,105 @@
+import itertools
+import math
+import operator
+
+from mdstools import profiling
+from mdstools.bars import BAR_FIELDS, BAR_SIZE, BarSeries
+
+POLICIES = ['reject', 'repair', 'drop', 'report']
+
+# Value checks whose rows 'drop' removes
+DROPPED = ['nan', 'ohlc', 'negative_volume']
+# Reported under every policy: exchange timezones with half-hour offsets
+# legitimately shift every bar off the UTC grid
+REPORTED = ['misaligned']
+
+
+class ValidationError(ValueError):
+    pass
+
+
+def any_of(*masks):
+    result = masks[0]
+    for mask in masks[1:]:
+        result = map(operator.or_, result, mask)
+    return list(result)
+
+
+def bad_rows(bars, timeframe_sec):
+    # Per-row masks built with map() over the column views, no per-bar objects
+    n = len(bars)
+    masks = {}
+    masks['nan'] = any_of(*[map(math.isnan, col) for col in (bars.opens, bars.highs, bars.lows, bars.closes)])
+    masks['ohlc'] = any_of(map(operator.gt, bars.lows, bars.highs),
+            map(operator.gt, bars.opens, bars.highs), map(operator.gt, bars.closes, bars.highs),
+            map(operator.lt, bars.opens, bars.lows), map(operator.lt, bars.closes, bars.lows))
+    # Parsers pack volume as signed so that negative values survive until here
+    signed_volumes = memoryview(bars.buffer).cast('q')[5::BAR_FIELDS]
+    masks['negative_volume'] = list(map(operator.lt, signed_volumes, itertools.repeat(0, n)))
+    # Daily and longer bars are aligned to the exchange's timezone, not UTC
+    if timeframe_sec is not None and timeframe_sec < 86400:
+        masks['misaligned'] = list(map(bool, map(operator.mod, bars.timestamps, itertools.repeat(timeframe_sec, n))))
+    return masks
+
+
+def check(bars, timeframe_sec=None):
+    ts = bars.timestamps
+    issues = {}
+    issues['duplicate'] = sum(map(operator.eq, ts[:-1], ts[1:]))
+    issues['out_of_order'] = sum(map(operator.gt, ts[:-1], ts[1:]))
+    masks = bad_rows(bars, timeframe_sec)
+    for name, mask in masks.items():
+        issues[name] = sum(mask)
+    return { k : v for k, v in issues.items() if v > 0 }, masks
+
+
+def format_issues(issues):
+    return ', '.join('{}: {}'.format(k, v) for k, v in sorted(issues.items()))
+
+
+def drop_rows(bars, bad):
+    view = memoryview(bars.buffer)
+    data = bytearray()
+    start = None
+    for i, is_bad in enumerate(bad):
+        if is_bad:
+            if start is not None:
+                data += view[start * BAR_SIZE:i * BAR_SIZE]
+                start = None
+        elif start is None:
+            start = i
+    if start is not None:
+        data += view[start * BAR_SIZE:]
+    return BarSeries(data)
+
+
+def validate(bars, timeframe_sec=None, policy='reject'):
+    # Returns (bars, issues). 'repair' sorts and drops duplicate timestamps,
+    # 'drop' also removes bars with invalid values; other issues are reported.
+    # REPORTED issues never reject or drop anything
+    if policy not in POLICIES:
+        raise ValueError('Invalid validation policy: {}'.format(policy))
+    issues, masks = check(bars, timeframe_sec)
+    if len(issues) == 0:
+        return bars, issues
+    if policy == 'reject' and any(k not in REPORTED for k in issues):
+        raise ValidationError(format_issues(issues))
+    if policy == 'drop':
+        bad = [masks[k] for k in DROPPED if k in issues]
+        if len(bad) > 0:
+            bars = drop_rows(bars, any_of(*bad))
+    if policy in ('repair', 'drop'):
+        bars = bars.dedup()
+    return bars, issues
+
+
+def validate_series(bars, timeframe_sec, policy, name):
+    # validate() with the log line shared by all tools; errors name the series
+    try:
+        with profiling.section('validate'):
+            bars, issues = validate(bars, timeframe_sec, policy)
+    except ValidationError as e:
+        raise ValidationError('{}: {}'.format(name, e))
+    if len(issues) > 0:
+        print("Validation ({}): {}: {}".format(policy, name, format_issues(issues)))
+    return bars
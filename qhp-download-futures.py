@@ -2,138 +2,73 @@
 
 import sys
 import argparse
-import zmq
-import io
-import json
+import bisect
+import contextlib
 import csv
 import datetime
-import struct
-import dateutil.tz
-
-def timeframe_to_seconds(tf):
-    if tf == 'M1':
-        return 60
-    elif tf == 'M5':
-        return 5 * 60
-    elif tf == 'M15':
-        return 15 * 60
-    elif tf == 'H1':
-        return 3600
-    elif tf == 'D':
-        return 86400
-    elif tf == 'W':
-        return 7 * 86400
-    else:
-        raise ValueError('Invalid value')
-
-class BarAggregator:
-    def __init__(self, timeframe):
-        self.open_ = 0
-        self.high = 0
-        self.low = 0
-        self.close = 0
-        self.volume = 0
-        self.timestamp = None
-        self.current_bar_number = None
-        self.timeframe = timeframe
-
-    def push_bar(self, timestamp, open_, high, low, close, volume):
-        bar_number = timestamp.timestamp() // self.timeframe
-        if bar_number != self.current_bar_number:
-            b_open = self.open_
-            b_high = self.high
-            b_low = self.low
-            b_close = self.close
-            b_volume = self.volume
-            if self.current_bar_number is not None:
-                b_timestamp = datetime.datetime.fromtimestamp(self.current_bar_number * self.timeframe)
-
-            self.open_ = open_
-            self.high = high
-            self.low = low
-            self.close = close
-            self.volume = volume
-            self.timestamp = timestamp
-            prev_bar_number = self.current_bar_number
-            self.current_bar_number = bar_number
-
-            if prev_bar_number is not None:
-                return (b_timestamp, b_open, b_high, b_low, b_close, b_volume)
-        else:
-            self.high = max(high, self.high)
-            self.low = min(low, self.low)
-            self.close = close
-            self.volume += volume
-            return None
-
-    def get_bar(self):
-        b_open = self.open_
-        b_high = self.high
-        b_low = self.low
-        b_close = self.close
-        b_volume = self.volume
-        b_timestamp = datetime.datetime.fromtimestamp(self.timeframe * ( self.timestamp.timestamp() // self.timeframe))
-
-        return (b_timestamp, b_open, b_high, b_low, b_close, b_volume)
-
-def get_data(qhp, ticker, start_time, end_time, period, tz, timedelta):
-    rq = {
-        "ticker" : ticker,
-        "from" : start_time.strftime("%Y-%m-%dT%H:%M:%S"),
-        "to" : end_time.strftime("%Y-%m-%dT%H:%M:%S"),
-        "timeframe" : period
-    }
-
-    qhp.send_multipart([bytes(json.dumps(rq), "utf-8")])
-    resp = qhp.recv()
-
-    if resp != b'OK':
-        errmsg = qhp.recv_string()
-        return None
-
-    bar_count = 0
-    result = []
-    while True:
-        if qhp.getsockopt(zmq.RCVMORE) == 0:
-            break
-        rawdata = qhp.recv()
-        for line in struct.iter_unpack("<qddddQ", rawdata):
-
-            timestamp = int(line[0])
-            open_ = float(line[1])
-            high = float(line[2])
-            low = float(line[3])
-            close = float(line[4])
-            volume = int(line[5])
-            dt = datetime.datetime.fromtimestamp(timestamp, tz) + timedelta
-
-            bar_count += 1
-            result.append((dt, open_, high, low, close, volume))
-
-    return result
+import mmap
+import os
+import tempfile
 
-def write_to_file(writer, bars, ticker, period):
-    for bar in bars:
-        writer.writerow([ticker, period, bar[0].strftime("%Y%m%d"), bar[0].strftime("%H%M%S"), bar[1], bar[2], bar[3], bar[4], bar[5]])
-
-def make_tickers_list(base, start_time, end_time, futures_interval):
-    result = []
-    month = start_time.date().month
-    year = start_time.date().year
-
-    while True:
-        if month % futures_interval == 0:
-            result.append(base + '-' + str(month) + '.' + str(year)[-2:])
-            if month > end_time.date().month and year >= end_time.date().year:
-                break
+from mdstools import profiling
+from mdstools.bars import BAR_SIZE, BarAggregator, BarSeries
+from mdstools.compression import open_output
+from mdstools.concurrency import AimdController, run_adaptive
+from mdstools.futures import ADJUST_METHODS, back_adjustments, make_tickers_list, roll_prices
+from mdstools.qhp import QhpClient, QhpError
 
-        month += 1
-        if month > 12:
-            month = 1
-            year += 1
-
-    return result
-            
+def write_to_file(writer, bars, ticker, period):
+    for bar in bars.rows():
+        dt = datetime.datetime.fromtimestamp(bar[0], datetime.timezone.utc)
+        writer.writerow([ticker, period, dt.strftime("%Y%m%d"), dt.strftime("%H%M%S"), bar[1], bar[2], bar[3], bar[4], bar[5]])
+
+# Bars read back per block when writing the stitched output
+SPILL_BLOCK = 65536
+
+def spill_contract(chunks, filename):
+    # Chunks go to disk as they come off the socket. QHP sends them in
+    # order; anything else is sorted and de-duplicated afterwards
+    count = 0
+    last_ts = None
+    ordered = True
+    with open(filename, 'wb') as f:
+        for chunk in chunks:
+            if len(chunk) == 0:
+                continue
+            if not chunk.is_sorted() or (last_ts is not None and chunk.timestamps[0] <= last_ts):
+                ordered = False
+            last_ts = chunk.timestamps[-1]
+            with profiling.section('spill'):
+                f.write(chunk.buffer)
+            count += len(chunk)
+    if not ordered:
+        with open(filename, 'rb') as f:
+            bars = BarSeries(f.read()).dedup()
+        with open(filename, 'wb') as f:
+            f.write(bars.buffer)
+        count = len(bars)
+    return count
+
+@contextlib.contextmanager
+def map_spill(filename):
+    # Binary searches over a spill file only touch the pages they need
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        bars = BarSeries(m)
+        try:
+            yield bars
+        finally:
+            bars.release()
+
+def read_spill(filename, start, end):
+    with open(filename, 'rb') as f:
+        f.seek(start * BAR_SIZE)
+        while start < end:
+            count = min(SPILL_BLOCK, end - start)
+            yield BarSeries(f.read(count * BAR_SIZE))
+            start += count
+
+def day_start(date):
+    return int(datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc).timestamp())
 
 def main():
     parser = argparse.ArgumentParser(description='QHP client')
@@ -148,23 +83,25 @@ def main():
     parser.add_argument('-i', '--futures-interval', action='store', dest='futures_interval', help='Futures interval between exprations in month', required=True)
     parser.add_argument('-s', '--stitch-delta', action='store', dest='stitch_delta', help='Futures interval between exprations in month', required=True)
     parser.add_argument('-e', '--replace-ticker', action='store', dest='replace_ticker', help='Replace ticker id in file', required=False)
+    parser.add_argument('-c', '--max-concurrency', action='store', dest='max_concurrency', type=int, default=8, help='Maximum number of in-flight QHP requests')
+    parser.add_argument('--timeout', action='store', dest='timeout', type=float, default=300, help='QHP request timeout (seconds)')
+    parser.add_argument('--spill-dir', action='store', dest='spill_dir', help='Directory for temporary contract files (default: system temp)')
+    parser.add_argument('--adjust', action='store', dest='adjust', choices=ADJUST_METHODS, help='Back-adjust prices of earlier contracts at each roll')
+    parser.add_argument('--profile', action='store', dest='profile', help='Write profiling report to file')
 
     args = parser.parse_args()
+    profiling.start(args.profile)
 
     period = args.timeframe
     symbol = args.symbol
     filename = args.output_file
 
-    ctx = zmq.Context.instance()
-    s = ctx.socket(zmq.REQ)
-    s.connect(args.qhp)
-
     start_time = datetime.datetime.strptime(args.from_, "%Y%m%d")
     end_time = datetime.datetime.strptime(args.to, "%Y%m%d")
 
-    timedelta = datetime.timedelta()
+    time_delta = 0
     if args.time_delta:
-        timedelta = datetime.timedelta(seconds=int(args.time_delta))
+        time_delta = int(args.time_delta)
 
     delta = int(args.stitch_delta)
 
@@ -172,39 +109,82 @@ def main():
     if args.rescale:
         agg = BarAggregator(int(args.rescale))
 
-    data = {}
     tickers = make_tickers_list(symbol, start_time, end_time, int(args.futures_interval))
     print("Tickers: {}".format(tickers))
-    for ticker in tickers:
-        print("Requesting data: {}".format(ticker))
-        bars = get_data(s, ticker, start_time, end_time, period, dateutil.tz.gettz('UTC'), timedelta)
 
-        if len(bars) > 0:
-            data[ticker] = { 'bars' : bars }
+    # Workers stream each contract into its own spill file; only the metadata
+    # needed to order and cut the contracts stays in memory
+    data = {}
+    with tempfile.TemporaryDirectory(prefix='qhp-futures-', dir=args.spill_dir) as spill_dir:
+        spill_files = { ticker : os.path.join(spill_dir, '{}.bin'.format(i)) for i, ticker in enumerate(tickers) }
+
+        def fetch(qhp, ticker):
+            print("Requesting data: {}".format(ticker))
+            try:
+                return spill_contract(qhp.iter_data(ticker, start_time, end_time, period, time_delta), spill_files[ticker])
+            except QhpError:
+                return None
+
+        controller = AimdController(maximum=args.max_concurrency)
+        for ticker, count in run_adaptive(tickers, fetch, lambda: QhpClient(args.qhp, args.timeout), controller):
+            if count is None:
+                print("Failed to get data: {}".format(ticker))
+                continue
+            if count == 0:
+                continue
+
             print("Cutting off trailing data: {}".format(ticker))
-            end_date = data[ticker]['bars'][-1][0]
-            cutoff_date = datetime.date.fromordinal(end_date.toordinal() - delta)
-            #cutoff_date_num = cutoff_date.year * 10000 + cutoff_date.month * 100 + cutoff_date.day
-
-            data[ticker]['bars'] = [s for s in data[ticker]['bars'] if s[0].date() <= cutoff_date]
-            data[ticker]['end_date'] = cutoff_date
-
-    prev_ticker = None
-    for k, v in sorted(data.items(), key=lambda x: x[1]['end_date']):
-        print("Cutting off starting data: {}".format(k))
-        if prev_ticker is not None:
-            start_date = data[prev_ticker]['bars'][-1][0]
-            v['bars'] = [s for s in data[k]['bars'] if s[0] > start_date]
-        prev_ticker = k
-        
-    with open(args.output_file, 'w+') as f:
-        writer = csv.writer(f)
-        writer.writerow(['<TICKER>', '<PER>', '<DATE>', '<TIME>', '<OPEN>', '<HIGH>', '<LOW>', '<CLOSE>', '<VOLUME>'])
-        for k, v in sorted(data.items(), key=lambda x: x[1]['end_date']):
-            ticker = args.replace_ticker
-            if ticker is None:
-                ticker = k
-            write_to_file(writer, v['bars'], k, period)
+            filename = spill_files[ticker]
+            with profiling.section('spill'), map_spill(filename) as bars:
+                end_date = datetime.datetime.fromtimestamp(bars.timestamps[-1], datetime.timezone.utc)
+                cutoff_date = datetime.date.fromordinal(end_date.toordinal() - delta)
+                end = bisect.bisect_left(bars.timestamps, day_start(cutoff_date) + 86400)
+                # The last bar is all the next contract's roll needs
+                last = BarSeries(bytes(bars.buffer[(end - 1) * BAR_SIZE:end * BAR_SIZE])) if end > 0 else None
+            if last is None:
+                print("Skipping {}: no data before the cutoff".format(ticker))
+                continue
+            data[ticker] = { 'file' : filename, 'end_date' : cutoff_date, 'start' : 0, 'end' : end, 'last' : last }
+
+        contracts = []
+        rolls = []
+        prev = None
+        # Workers finish in any order; ties on the cutoff date go by ticker list order
+        for k, v in sorted(data.items(), key=lambda x: (x[1]['end_date'], tickers.index(x[0]))):
+            print("Cutting off starting data: {}".format(k))
+            roll = None
+            if prev is not None:
+                if v['last'].timestamps[-1] <= prev['last'].timestamps[-1]:
+                    # Nothing left after the cut, and it must not move the next cut back
+                    print("Skipping {}: covered by the previous contract".format(k))
+                    continue
+                with profiling.section('spill'), map_spill(v['file']) as bars:
+                    v['start'] = bisect.bisect_left(bars.timestamps, prev['last'].timestamps[-1] + 1)
+                    if args.adjust is not None:
+                        roll = roll_prices(prev['last'], bars)
+            contracts.append((k, v))
+            rolls.append(roll)
+            prev = v
+
+        adjustments = [(0.0, 1.0)] * len(contracts)
+        if args.adjust is not None:
+            try:
+                adjustments = back_adjustments(rolls, args.adjust)
+            except ValueError as e:
+                print("Adjustment failed: {}".format(e))
+                sys.exit(1)
+
+        with open_output(args.output_file) as f:
+            writer = csv.writer(f)
+            writer.writerow(['<TICKER>', '<PER>', '<DATE>', '<TIME>', '<OPEN>', '<HIGH>', '<LOW>', '<CLOSE>', '<VOLUME>'])
+            for (k, v), (offset, factor) in zip(contracts, adjustments):
+                ticker = args.replace_ticker
+                if ticker is None:
+                    ticker = k
+                for bars in read_spill(v['file'], v['start'], v['end']):
+                    with profiling.section('write'):
+                        write_to_file(writer, bars.adjust(offset, factor), k, period)
+                os.remove(v['file'])
 
 if __name__ == '__main__':
     main()
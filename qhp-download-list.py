@@ -2,47 +2,44 @@
 
 import sys
 import argparse
-import zmq
-import io
-import json
-import csv
-import datetime
-import struct
+
+from mdstools.catalog import TickerCatalog
+from mdstools.qhp import QhpClient, QhpError
 
 def main():
     parser = argparse.ArgumentParser(description='QHP client')
     parser.add_argument('-q', '--qhp', action='store', dest='qhp', help='QHP endpoint', required=True)
+    parser.add_argument('-l', '--catalog', action='store', dest='catalog', help='Local ticker catalog file')
+    parser.add_argument('--catalog-ttl', action='store', dest='catalog_ttl', type=float, default=86400, help='Catalog refresh interval (seconds)')
+    parser.add_argument('--changes', action='store_true', dest='changes', help='Print only added (+) and removed (-) tickers')
 
     args = parser.parse_args()
 
-    ctx = zmq.Context.instance()
-    s = ctx.socket(zmq.REQ)
-    s.connect(args.qhp)
-
-    rq = {
-        "get_sec_list" : True,
-    }
-
-    s.send_multipart([bytes(json.dumps(rq), "utf-8")])
-    resp = s.recv()
-
-    if resp != b'OK':
-        errmsg = s.recv_string()
-        print("Error:", errmsg)
-        sys.exit(1)
+    def fetch_tickers():
+        with QhpClient(args.qhp) as qhp:
+            try:
+                return qhp.request_ticker_list()
+            except QhpError as e:
+                print("Error:", e)
+                sys.exit(1)
+
+    if args.catalog is None:
+        if args.changes:
+            parser.error('--changes requires --catalog')
+        tickers = fetch_tickers()
+    else:
+        catalog = TickerCatalog(args.catalog, args.catalog_ttl)
+        tickers, added, removed = catalog.update(fetch_tickers, force=args.changes)
+        catalog.save()
+        if args.changes:
+            for ticker in added:
+                print("+" + ticker)
+            for ticker in removed:
+                print("-" + ticker)
+            return
 
-
-    rawdata = b''
-    while True:
-        if s.getsockopt(zmq.RCVMORE) == 0:
-            break
-        rawdata += s.recv()
-
-    s = rawdata.decode('utf-8')
-    tickers = s.split(',')
     for ticker in tickers:
         print(ticker)
 
 if __name__ == '__main__':
     main()
-
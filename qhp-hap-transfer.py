@@ -2,221 +2,185 @@
 
 import sys
 import argparse
-import zmq
-import io
-import json
-import csv
 import datetime
-import struct
-import re
 import dateutil.tz
 
-def sec_from_period(period):
-    if period == "M1":
-        return 60
-    elif period == "M5":
-        return 60 * 5
-    elif period == "M15":
-        return 60 * 15
-    elif period == "M30":
-        return 60 * 30
-    elif period == "H1":
-        return 60 * 60
-    elif period == "D":
-        return 86400
-
-def request_ticker_list(socket):
-    rq = {
-        "get_sec_list" : True,
-    }
-
-    socket.send_multipart([bytes(json.dumps(rq), "utf-8")])
-    resp = socket.recv()
-
-    if resp != b'OK':
-        errmsg = s.recv_string()
-        print("Error:", errmsg)
-        sys.exit(1)
-
-
-    rawdata = b''
-    while True:
-        if socket.getsockopt(zmq.RCVMORE) == 0:
-            break
-        rawdata += socket.recv()
-
-    s = rawdata.decode('utf-8')
-    tickers = s.split(',')
-    
-    print("Got {} tickers".format(len(tickers)))
-    return tickers
-
-def get_month_by_code(code):
-    try:
-        mon = ['F', 'G', 'H', 'J', 'K', 'M', 'N', 'Q', 'U', 'V', 'X', 'Z'].index(code)
-    except ValueError:
-        return None
-    return mon + 1
-
-def get_data(qhp, ticker, start_time, end_time, period, tz, timedelta):
-    rq = {
-        "ticker" : ticker,
-        "from" : start_time.strftime("%Y-%m-%dT%H:%M:%S"),
-        "to" : end_time.strftime("%Y-%m-%dT%H:%M:%S"),
-        "timeframe" : period
-    }
-
-    qhp.send_multipart([bytes(json.dumps(rq), "utf-8")])
-    resp = qhp.recv()
-
-    if resp != b'OK':
-        errmsg = qhp.recv_string()
-        return None
-
-    bar_count = 0
-    result = []
-    while True:
-        if qhp.getsockopt(zmq.RCVMORE) == 0:
-            break
-        rawdata = qhp.recv()
-        for line in struct.iter_unpack("<qddddQ", rawdata):
-
-            timestamp = int(line[0])
-            open_ = float(line[1])
-            high = float(line[2])
-            low = float(line[3])
-            close = float(line[4])
-            volume = int(line[5])
-            dt = datetime.datetime.fromtimestamp(timestamp, tz) + timedelta
-
-            bar_count += 1
-            result.append((dt, open_, high, low, close, volume))
-
-    return result
-
-def upload_data(hap, data, ticker, period):
-    print("Uploading ticker: {}".format(ticker))
-    serialized_bars = io.BytesIO()
-    min_dt = None
-    max_dt = None
-
-    for bar in data:
-        dt = bar[0]
-        serialized_bars.write(struct.pack("<qddddQ", int(dt.timestamp()), bar[1], bar[2], bar[3], bar[4], bar[5]))
-        if min_dt is None:
-            min_dt = dt
-        else:
-            if dt < min_dt:
-                min_dt = dt
-
-        if max_dt is None:
-            max_dt = dt
-        else:
-            if dt > max_dt:
-                max_dt = dt
-
-    rq = {
-        "ticker" : ticker,
-        "start_time" : min_dt.strftime("%Y-%m-%dT%H:%M:%S"),
-        "end_time" : max_dt.strftime("%Y-%m-%dT%H:%M:%S"),
-        "timeframe_sec" : sec_from_period(period)
-    }
-
-    raw_data = serialized_bars.getvalue()
-
-    hap.send_multipart([bytes(json.dumps(rq), "utf-8"), raw_data])
-    parts = hap.recv_multipart()
-    if parts[0] != b'OK':
-        return False
-    return True
-
-def convert_ticker(s, data):
-    if s.startswith("SPBFUT#"):
-        last_ts = data[-1][0]
-        year = int(s[-1])
-        current_year = last_ts.date().year - 2000
-        current_year_in_dec = current_year % 10
-        current_dec = current_year - current_year_in_dec
-        current_mon = last_ts.date().month
-        mon = get_month_by_code(s[-2])
-        if year >= current_year_in_dec:
-            return s[:-2] + ".{}-{}".format(mon, current_dec + year)
-        else:
-            return s[:-2] + ".{}-{}".format(mon, current_dec + 10 + year)
-            
-    else:
-        return s
-
-def load_blacklist(filename):
-    result = []
-    with open(filename, 'r') as f:
-        lines = f.readlines()
-        for line in lines:
-            line = line.strip()
-            if line != "":
-                result.append(re.compile(line))
-
-    return result
-
-def allow_ticker(blacklist, ticker):
-    for rx in blacklist:
-        if rx.match(ticker):
-            return False
-    return True 
-
+from mdstools import profiling
+from mdstools.bars import BarSeries
+from mdstools.blacklist import allow_ticker, load_blacklist
+from mdstools.catalog import TickerCatalog
+from mdstools.concurrency import AimdController, run_adaptive
+from mdstools.dataset import FORMATS, Dataset
+from mdstools.futures import convert_ticker
+from mdstools.hap import HapClient
+from mdstools.qhp import BatchNotSupported, QhpClient, QhpError
+from mdstools.timeframes import sec_from_period
+from mdstools.validation import POLICIES, ValidationError, validate_series
 
 def main():
     parser = argparse.ArgumentParser(description='QHP-HAP transfer agent')
     parser.add_argument('-q', '--qhp', action='store', dest='qhp', help='QHP endpoint', required=True)
-    parser.add_argument('-a', '--hap', action='store', dest='hap', help='HAP endpoint', required=True)
+    parser.add_argument('-a', '--hap', action='store', dest='hap', help='HAP endpoints: comma-separated shards, \'|\'-separated replicas')
+    parser.add_argument('-D', '--dataset-root', action='store', dest='dataset_root', help='Also write into partitioned dataset at given root')
+    parser.add_argument('--dataset-format', action='store', dest='dataset_format', choices=FORMATS, default='bin', help='Partition format for new datasets')
     parser.add_argument('-f', '--from', action='store', dest='from_', help='Starting date', required=True)
     parser.add_argument('-t', '--to', action='store', dest='to', help='Ending date', required=True)
     parser.add_argument('-p', '--period', action='store', dest='period', help='Timeframe', required=True)
     parser.add_argument('-d', '--time-delta', action='store', dest='time_delta', help='Add given time delta (in seconds)')
     parser.add_argument('-z', '--timezone', action='store', dest='timezone', help='Timezone')
     parser.add_argument('-b', '--blacklist-file', action='store', dest='blacklist_file', help='File with blacklisted tickers')
+    parser.add_argument('-l', '--catalog', action='store', dest='catalog', help='Local ticker catalog file')
+    parser.add_argument('--catalog-ttl', action='store', dest='catalog_ttl', type=float, default=86400, help='Catalog refresh interval (seconds)')
+    parser.add_argument('--new-only', action='store_true', dest='new_only', help='Only transfer tickers added to the catalog since the last run')
+    parser.add_argument('-c', '--max-concurrency', action='store', dest='max_concurrency', type=int, default=16, help='Maximum number of in-flight QHP requests')
+    parser.add_argument('-n', '--batch-size', action='store', dest='batch_size', type=int, default=50, help='Tickers per batched QHP request (0 to disable)')
+    parser.add_argument('--batch-max-bars', action='store', dest='batch_max_bars', type=int, default=5000, help='Tickers with more bars are requested separately')
+    parser.add_argument('--timeout', action='store', dest='timeout', type=float, default=300, help='QHP request timeout (seconds)')
+    parser.add_argument('--hap-timeout', action='store', dest='hap_timeout', type=float, default=300, help='HAP acknowledgement timeout before failover (seconds)')
+    parser.add_argument('--validate', action='store', dest='validation', choices=POLICIES, help='Check bars before upload: reject, repair (sort, drop duplicate timestamps), drop (repair and drop invalid bars) or report')
+    parser.add_argument('--profile', action='store', dest='profile', help='Write profiling report to file')
 
     args = parser.parse_args()
+    profiling.start(args.profile)
+
+    if args.hap is None and args.dataset_root is None:
+        parser.error('at least one of --hap and --dataset-root is required')
+    if args.new_only and args.catalog is None:
+        parser.error('--new-only requires --catalog')
 
     start_time = datetime.datetime.strptime(args.from_, "%Y%m%d")
     end_time = datetime.datetime.strptime(args.to, "%Y%m%d")
 
-    ctx = zmq.Context.instance()
-    qhp = ctx.socket(zmq.REQ)
-    qhp.connect(args.qhp)
-
-    hap = ctx.socket(zmq.REQ)
-    hap.connect(args.hap)
-
-    tickers = request_ticker_list(qhp)
+    hap = None
+    if args.hap is not None:
+        hap = HapClient(args.hap, timeout=args.hap_timeout)
+
+    dataset = None
+    if args.dataset_root is not None:
+        dataset = Dataset(args.dataset_root, args.period, args.dataset_format)
+
+    def fetch_tickers():
+        with QhpClient(args.qhp) as qhp:
+            try:
+                return qhp.request_ticker_list()
+            except QhpError as e:
+                print("Error:", e)
+                sys.exit(1)
+
+    catalog = None
+    if args.catalog is not None:
+        catalog = TickerCatalog(args.catalog, args.catalog_ttl)
+        tickers, added, removed = catalog.update(fetch_tickers, force=args.new_only)
+        print("Catalog: {} tickers, {} added, {} removed".format(len(tickers), len(added), len(removed)))
+        if args.new_only:
+            tickers = added
+    else:
+        tickers = fetch_tickers()
+    print("Got {} tickers".format(len(tickers)))
 
     tz = dateutil.tz.gettz('UTC')
     if args.timezone is not None:
         tz = dateutil.tz.gettz(args.timezone)
 
-    timedelta = datetime.timedelta(seconds=0)
+    time_delta = 0
     if args.time_delta is not None:
-        timedelta = datetime.timedelta(seconds=int(args.time_delta))
+        time_delta = int(args.time_delta)
 
-    blacklist = []
+    blacklist = None
     if args.blacklist_file is not None:
         blacklist = load_blacklist(args.blacklist_file)
-            
-        
-    max_retries = 3
+
+    allowed = []
     for ticker in tickers:
-        for trynum in range(0, max_retries):
-            if allow_ticker(blacklist, ticker):
-                print("Requesting ticker from QHP: {}".format(ticker))
-                data = get_data(qhp, ticker, start_time, end_time, args.period, tz, timedelta)
-                if data is not None:
-                    if len(data) > 0:
-                        upload_data(hap, data, convert_ticker(ticker, data), args.period)
-                    break
-                else:
-                    print("Timeout, retry {} of {}".format(trynum + 1, max_retries))
-            else:
-                print("Skipping blacklisted ticker: {}".format(ticker))
+        if allow_ticker(blacklist, ticker):
+            allowed.append(ticker)
+        else:
+            print("Skipping blacklisted ticker: {}".format(ticker))
+
+    # Tickers that did not make it; kept out of the catalog so they are retried
+    failed = set()
+
+    def upload(ticker, chunks):
+        chunks = [c for c in chunks if len(c) > 0]
+        if args.validation is not None and len(chunks) > 0:
+            # Validated once here so that the dataset and HAP get the same bars
+            try:
+                bars = validate_series(BarSeries.concat(chunks), sec_from_period(args.period), args.validation, ticker)
+            except ValidationError as e:
+                print("Validation failed: {}".format(e))
+                failed.add(ticker)
+                return
+            chunks = [bars] if len(bars) > 0 else []
+        if len(chunks) == 0:
+            return
+        out_ticker = convert_ticker(ticker, datetime.datetime.fromtimestamp(chunks[-1].timestamps[-1], tz))
+        print("Uploading ticker: {}".format(out_ticker))
+
+        def done(ok, parts):
+            if not ok:
+                print("Upload failed: {}: {}".format(out_ticker, parts))
+                failed.add(ticker)
+
+        if dataset is not None:
+            dataset.write(out_ticker, BarSeries.concat(chunks))
+        if hap is not None:
+            hap.upload(out_ticker, chunks, args.period, tz=tz, callback=done)
+
+    batch_supported = [args.batch_size > 0]
+
+    def fetch_batch(qhp, batch):
+        if not batch_supported[0]:
+            return {}, list(batch)
+        print("Requesting batch of {} tickers from QHP".format(len(batch)))
+        try:
+            return qhp.get_data_batch(batch, start_time, end_time, args.period, args.batch_max_bars, time_delta)
+        except BatchNotSupported:
+            print("QHP does not support batched requests, falling back to per-ticker requests")
+            batch_supported[0] = False
+            return {}, list(batch)
+        except QhpError as e:
+            print("Batch request failed: {}".format(e))
+            return None
+
+    def fetch(qhp, ticker):
+        print("Requesting ticker from QHP: {}".format(ticker))
+        try:
+            return list(qhp.iter_data(ticker, start_time, end_time, args.period, time_delta))
+        except QhpError:
+            return None
+
+    make_socket = lambda: QhpClient(args.qhp, args.timeout)
+
+    single = allowed
+    if batch_supported[0]:
+        single = []
+        batches = [tuple(allowed[i:i + args.batch_size]) for i in range(0, len(allowed), args.batch_size)]
+        controller = AimdController(maximum=args.max_concurrency)
+        for batch, result in run_adaptive(batches, fetch_batch, make_socket, controller):
+            if result is None:
+                single += batch
+                continue
+            data, deferred = result
+            for ticker, bars in data.items():
+                upload(ticker, bars)
+            single += deferred
+
+    controller = AimdController(maximum=args.max_concurrency)
+    for ticker, data in run_adaptive(single, fetch, make_socket, controller):
+        if data is None:
+            print("Giving up on ticker: {}".format(ticker))
+            failed.add(ticker)
+        else:
+            upload(ticker, data)
+
+    if hap is not None:
+        hap.close()
+
+    if catalog is not None:
+        if len(failed) > 0:
+            print("Not recording {} failed tickers in the catalog".format(len(failed)))
+            catalog.forget(failed)
+        catalog.save()
                 
 
 if __name__ == '__main__':
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import sys
+import argparse
+import zmq
+import json
+import datetime
+import struct
+import random
+import threading
+import time
+
+from mdstools.timeframes import sec_from_period
+
+def parse_time(x):
+    return int(datetime.datetime.strptime(x, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=datetime.timezone.utc).timestamp())
+
+def make_bars(ticker, start, end, period):
+    # Deterministic random walk; bar count depends on the ticker so that
+    # the ticker list contains both small and large instruments
+    rnd = random.Random(ticker)
+    step = sec_from_period(period)
+    if step is None:
+        raise ValueError('Invalid value')
+    count = rnd.choice([0, 10, 100, 10000])
+    start = start - start % step
+    end = min(end, start + count * step)
+    price = rnd.uniform(10, 1000)
+    result = bytearray()
+    for ts in range(start, end, step):
+        open_ = price
+        price = max(0.01, price + rnd.uniform(-1, 1))
+        high = max(open_, price) + rnd.uniform(0, 0.5)
+        low = min(open_, price) - rnd.uniform(0, 0.5)
+        result += struct.pack("<qddddQ", ts, open_, high, low, price, rnd.randint(1, 1000))
+    return bytes(result)
+
+def handle(s, rq, args):
+    if rq.get('get_sec_list'):
+        s.send_multipart([b'OK', bytes(','.join(args.tickers), 'utf-8')])
+    elif 'start_time' in rq:
+        # HAP upload
+        s.send_multipart([b'OK'])
+    elif 'tickers' in rq:
+        if args.no_batch:
+            s.send_multipart([b'ERROR', b'Invalid request'])
+            return
+        start = parse_time(rq['from'])
+        end = parse_time(rq['to'])
+        max_bars = rq.get('max_bars')
+        parts = [b'OK', b'BATCH']
+        for ticker in rq['tickers']:
+            data = make_bars(ticker, start, end, rq['timeframe'])
+            if max_bars is not None and len(data) // 48 > max_bars:
+                parts += [bytes(json.dumps({ 'ticker' : ticker, 'status' : 'DEFER' }), 'utf-8'), b'']
+            else:
+                parts += [bytes(json.dumps({ 'ticker' : ticker, 'status' : 'OK' }), 'utf-8'), data]
+        s.send_multipart(parts)
+    elif 'ticker' in rq:
+        data = make_bars(rq['ticker'], parse_time(rq['from']), parse_time(rq['to']), rq['timeframe'])
+        chunk = 4096 * 48
+        s.send_multipart([b'OK'] + [data[i:i + chunk] for i in range(0, len(data), chunk)])
+    else:
+        s.send_multipart([b'ERROR', b'Invalid request'])
+
+def serve(ctx, args):
+    s = ctx.socket(zmq.REP)
+    s.connect('inproc://workers')
+    while True:
+        parts = s.recv_multipart()
+        if args.latency > 0:
+            time.sleep(args.latency)
+        try:
+            handle(s, json.loads(parts[0]), args)
+        except (ValueError, KeyError) as e:
+            s.send_multipart([b'ERROR', bytes(str(e), 'utf-8')])
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in QHP/HAP server for testing')
+    parser.add_argument('-b', '--bind', action='store', dest='bind', help='Endpoint to bind to', required=True)
+    parser.add_argument('-n', '--ticker-count', action='store', dest='ticker_count', type=int, default=100, help='Number of tickers to serve')
+    parser.add_argument('-w', '--workers', action='store', dest='workers', type=int, default=4, help='Number of worker threads')
+    parser.add_argument('-l', '--latency', action='store', dest='latency', type=float, default=0, help='Artificial latency per request (seconds)')
+    parser.add_argument('--no-batch', action='store_true', dest='no_batch', help='Reject batched requests like an old QHP')
+
+    args = parser.parse_args()
+    args.tickers = ['TEST{}'.format(i) for i in range(0, args.ticker_count)]
+
+    ctx = zmq.Context.instance()
+    front = ctx.socket(zmq.ROUTER)
+    front.bind(args.bind)
+    back = ctx.socket(zmq.DEALER)
+    back.bind('inproc://workers')
+
+    for i in range(0, args.workers):
+        threading.Thread(target=serve, args=(ctx, args), daemon=True).start()
+
+    print("Serving {} tickers on {}".format(len(args.tickers), args.bind))
+    zmq.proxy(front, back)
+
+if __name__ == '__main__':
+    main()
@@ -5,76 +5,233 @@ import argparse
 import csv
 import os
 import datetime
+import calendar
+import struct
+import multiprocessing
+
+from mdstools import profiling
+from mdstools.bars import BAR_FORMAT, PARSED_BAR_FORMAT, BarSeries
+from mdstools.compression import open_input, open_output
+from mdstools.dataset import Dataset
+from mdstools.futures import ADJUST_METHODS, back_adjustments, roll_prices
+from mdstools.manifest import Manifest, fingerprint
+from mdstools.timeframes import sec_from_period
+from mdstools.validation import POLICIES, ValidationError, validate_series
 
 def parse_date(x):
     return datetime.datetime.strptime(x, '%Y%m%d').date()
 
-def read_file(f):
+def day_start(date):
+    return calendar.timegm((date.year, date.month, date.day, 0, 0, 0))
+
+def read_file(f, bar_format=BAR_FORMAT):
     reader = csv.reader(f, delimiter=',')
-    ticker = None
     next(reader)
-    result = { 'bars' : [] }
+    result = { 'ticker' : None, 'period' : None }
 
+    data = bytearray()
+    pack = struct.Struct(bar_format).pack
     for line in reader:
-        result['bars'].append(line)
-        if ticker is None:
-            ticker =  line[0]
-            result['ticker'] = ticker
-
+        if result['ticker'] is None:
+            result['ticker'] = line[0]
+            result['period'] = line[1]
+        date = line[2]
+        time = line[3]
+        timestamp = calendar.timegm((int(date[0:4]), int(date[4:6]), int(date[6:8]), int(time[0:2]), int(time[2:4]), int(time[4:6])))
+        data += pack(timestamp, float(line[4]), float(line[5]), float(line[6]), float(line[7]), int(line[8]))
+
+    result['bars'] = BarSeries(data)
     return result
 
-def write_to_file(writer, bars, ticker):
-    for bar in bars:
-        if ticker is not None:
-            bar[0] = ticker
-        writer.writerow(bar)
-
-
-def main():
-    parser = argparse.ArgumentParser(description='Stitch futures')
-    parser.add_argument('-i', '--input-directory', action='store', dest='input_directory', help='Input directory', required=True)
-    parser.add_argument('-o', '--output-file', action='store', dest='output_file', help='Output filename', required=True)
-    parser.add_argument('-d', '--stitch-delta', action='store', dest='stitch_delta', help='Offset at which stitching occurs (days)', required=False)
-    parser.add_argument('-t', '--ticker', action='store', dest='replace_ticker', help='Replace ticker')
-
-    args = parser.parse_args()
+def format_price(x):
+    # Inputs are passed through as text, keep whole prices like '112340'
+    s = repr(x)
+    return s[:-2] if s.endswith('.0') else s
 
-    input_directory = args.input_directory
-    output_file = args.output_file
-    delta = int(args.stitch_delta)
+def write_to_file(writer, bars, ticker, period):
+    for bar in bars.rows():
+        dt = datetime.datetime.utcfromtimestamp(bar[0])
+        writer.writerow([ticker, period, dt.strftime('%Y%m%d'), dt.strftime('%H%M%S'), format_price(bar[1]), format_price(bar[2]), format_price(bar[3]), format_price(bar[4]), bar[5]])
 
-    ticker = args.replace_ticker
 
+def load_directory(input_directory, validation=None):
+    bar_format = BAR_FORMAT if validation is None else PARSED_BAR_FORMAT
     data = []
     for filename in os.listdir(input_directory):
         full_name = os.path.join(input_directory, filename)
         print("Reading {}".format(full_name))
-        with open(full_name, 'r') as f:
-            data.append(read_file(f))
+        with open_input(full_name) as f, profiling.section('read'):
+            data.append(read_file(f, bar_format))
+    return data
+
+def load_dataset(dataset, symbol, start_time, end_time):
+    start = None
+    if start_time is not None:
+        start = day_start(start_time)
+    end = None
+    if end_time is not None:
+        end = day_start(end_time) + 86400
+
+    data = []
+    for ticker in dataset.tickers():
+        if not ticker.startswith(symbol + '-'):
+            continue
+        print("Reading {}".format(ticker))
+        bars = BarSeries.concat(list(dataset.read(ticker, start, end)))
+        if len(bars) > 0:
+            # Roll dates depend on the contract's last bar, not on the requested range
+            data.append({ 'ticker' : ticker, 'period' : dataset.timeframe, 'bars' : bars, 'last_timestamp' : dataset.last_timestamp(ticker) })
+    return data
+
+def stitch(input_directory, output_file, delta, ticker, validation=None, adjust=None):
+    stitch_data(load_directory(input_directory, validation), output_file, delta, ticker, validation, adjust)
+
+def validate_contracts(data, validation):
+    result = []
+    for f in data:
+        f['bars'] = validate_series(f['bars'], sec_from_period(f['period']), validation, f['ticker'])
+        if len(f['bars']) > 0:
+            result.append(f)
+    return result
+
+def stitch_data(data, output_file, delta, ticker, validation=None, adjust=None):
+    if validation is not None:
+        data = validate_contracts(data, validation)
 
-        
     for f in data:
         print("Cutting off trailing data: {}".format(f['ticker']))
-        end_date = parse_date(f['bars'][-1][2])
+        f['bars'] = f['bars'].dedup()
+        end_date = datetime.datetime.utcfromtimestamp(f.get('last_timestamp', f['bars'].timestamps[-1])).date()
         cutoff_date = datetime.date.fromordinal(end_date.toordinal() - delta)
-        cutoff_date_num = cutoff_date.year * 10000 + cutoff_date.month * 100 + cutoff_date.day
 
-        f['bars'] = [s for s in f['bars'] if int(s[2]) <= cutoff_date_num]
+        f['bars'] = f['bars'].slice_time(None, day_start(cutoff_date) + 86400)
         f['end_date'] = cutoff_date
 
+    data = [f for f in data if len(f['bars']) > 0]
     data.sort(key=lambda x: x['end_date'])
 
-    for i in range(1, len(data)):
-        print("Cutting off starting data: {}".format(data[i]['ticker']))
-        start_date = parse_date(data[i - 1]['bars'][-1][2])
-        start_date_num = start_date.year * 10000 + start_date.month * 100 + start_date.day
-        data[i]['bars'] = [s for s in data[i]['bars'] if int(s[2]) > start_date_num]
-
-    with open(args.output_file, 'w+') as f:
+    prev = None
+    rolls = [None] * len(data)
+    for i, d in enumerate(data):
+        if prev is not None:
+            print("Cutting off starting data: {}".format(d['ticker']))
+            uncut = d['bars']
+            start_date = datetime.datetime.utcfromtimestamp(prev.timestamps[-1]).date()
+            d['bars'] = d['bars'].slice_time(day_start(start_date) + 86400)
+            # A contract covered entirely by its predecessor is not a roll
+            if len(d['bars']) > 0:
+                rolls[i] = roll_prices(prev, uncut)
+        if len(d['bars']) > 0:
+            prev = d['bars']
+
+    adjustments = [(0.0, 1.0)] * len(data)
+    if adjust is not None:
+        adjustments = back_adjustments(rolls, adjust)
+
+    with open_output(output_file) as f:
         writer = csv.writer(f)
         writer.writerow(['<TICKER>', '<PER>', '<DATE>', '<TIME>', '<OPEN>', '<HIGH>', '<LOW>', '<CLOSE>', '<VOLUME>'])
-        for d in data:
-            write_to_file(writer, d['bars'], ticker)
+        for d, (offset, factor) in zip(data, adjustments):
+            with profiling.section('write'):
+                write_to_file(writer, d['bars'].adjust(offset, factor), ticker if ticker is not None else d['ticker'], d['period'])
+
+def directory_fingerprint(input_directory, delta, validation, adjust):
+    files = {}
+    for filename in sorted(os.listdir(input_directory)):
+        files[filename] = fingerprint(os.path.join(input_directory, filename))
+    return { 'delta' : delta, 'validation' : validation, 'adjust' : adjust, 'files' : files }
+
+def stitch_underlying(job):
+    underlying, input_directory, output_file, delta, validation, adjust = job
+    try:
+        stitch(input_directory, output_file, delta, None, validation, adjust)
+    except Exception as e:
+        # One malformed input must not take the rest of the batch down
+        return underlying, '{}: {}'.format(type(e).__name__, e)
+    return underlying, None
+
+def stitch_batch(input_root, output_dir, delta, jobs, validation=None, adjust=None):
+    os.makedirs(output_dir, exist_ok=True)
+    with Manifest(os.path.join(output_dir, '.stitch_futures.manifest')) as manifest:
+        pending = []
+        fingerprints = {}
+        for underlying in sorted(os.listdir(input_root)):
+            input_directory = os.path.join(input_root, underlying)
+            if not os.path.isdir(input_directory):
+                continue
+            output_file = os.path.join(output_dir, underlying + '.csv')
+            fp = directory_fingerprint(input_directory, delta, validation, adjust)
+            if manifest.is_done(underlying, fp) and os.path.exists(output_file):
+                continue
+            fingerprints[underlying] = fp
+            pending.append((underlying, input_directory, output_file, delta, validation, adjust))
+
+        print("{} underlyings to stitch".format(len(pending)))
+        failed = 0
+        profiling.mark_partial('stitching runs in unprofiled worker processes')
+        with multiprocessing.Pool(jobs, initializer=profiling.detach) as pool:
+            for underlying, error in pool.imap_unordered(stitch_underlying, pending):
+                if error is None:
+                    manifest.record(underlying, fingerprints[underlying], 'ok')
+                    print("Stitched {}".format(underlying))
+                else:
+                    failed += 1
+                    manifest.record(underlying, fingerprints[underlying], 'failed', error=error)
+                    print("Failed to stitch {}: {}".format(underlying, error))
+
+    return failed == 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Stitch futures')
+    parser.add_argument('-i', '--input-directory', action='store', dest='input_directory', help='Input directory')
+    parser.add_argument('-o', '--output-file', action='store', dest='output_file', help='Output filename')
+    parser.add_argument('-I', '--input-root', action='store', dest='input_root', help='Directory of per-underlying input directories (batch mode)')
+    parser.add_argument('-O', '--output-directory', action='store', dest='output_directory', help='Output directory (batch mode)')
+    parser.add_argument('-j', '--jobs', action='store', dest='jobs', type=int, help='Worker processes in batch mode')
+    parser.add_argument('-D', '--dataset-root', action='store', dest='dataset_root', help='Read contracts from partitioned dataset')
+    parser.add_argument('-p', '--timeframe', action='store', dest='timeframe', help='Dataset timeframe')
+    parser.add_argument('-y', '--symbol', action='store', dest='symbol', help='Base symbol of dataset contracts')
+    parser.add_argument('--from', action='store', dest='from_', help='Starting date (dataset mode)')
+    parser.add_argument('--to', action='store', dest='to', help='Ending date (dataset mode)')
+    parser.add_argument('-d', '--stitch-delta', action='store', dest='stitch_delta', help='Offset at which stitching occurs (days)', required=False)
+    parser.add_argument('-t', '--ticker', action='store', dest='replace_ticker', help='Replace ticker')
+    parser.add_argument('--adjust', action='store', dest='adjust', choices=ADJUST_METHODS, help='Back-adjust prices of earlier contracts at each roll')
+    parser.add_argument('--validate', action='store', dest='validation', choices=POLICIES, help='Check contracts before stitching: reject, repair (sort, drop duplicate timestamps), drop (repair and drop invalid bars) or report')
+    parser.add_argument('--profile', action='store', dest='profile', help='Write profiling report to file')
+
+    args = parser.parse_args()
+    profiling.start(args.profile)
+
+    delta = int(args.stitch_delta)
+
+    if args.input_root is not None:
+        if args.output_directory is None:
+            parser.error('--output-directory is required in batch mode')
+        if args.replace_ticker is not None:
+            parser.error('--ticker can not be used in batch mode')
+        if not stitch_batch(args.input_root, args.output_directory, delta, args.jobs, args.validation, args.adjust):
+            sys.exit(1)
+        return
+
+    if args.dataset_root is not None:
+        if args.output_file is None or args.timeframe is None or args.symbol is None:
+            parser.error('--output-file, --timeframe and --symbol are required in dataset mode')
+        start_time = parse_date(args.from_) if args.from_ is not None else None
+        end_time = parse_date(args.to) if args.to is not None else None
+        data = load_dataset(Dataset(args.dataset_root, args.timeframe), args.symbol, start_time, end_time)
+    else:
+        if args.input_directory is None or args.output_file is None:
+            parser.error('--input-directory and --output-file are required')
+        data = load_directory(args.input_directory, args.validation)
+
+    try:
+        stitch_data(data, args.output_file, delta, args.replace_ticker, args.validation, args.adjust)
+    except ValidationError as e:
+        print("Validation failed: {}".format(e))
+        sys.exit(1)
+    except ValueError as e:
+        print("Stitching failed: {}".format(e))
+        sys.exit(1)
         
 
 if __name__ == '__main__':